@@ -1,11 +1,42 @@
-from hmac import new
+from hmac import new, compare_digest
 from hashlib import sha256
+from functools import lru_cache
+from re import compile
+from utils import update_digests
+
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+STREAMING_PAYLOAD = "STREAMING-AWS4-HMAC-SHA256-PAYLOAD"
+STREAMING_UNSIGNED_TRAILER = "STREAMING-UNSIGNED-PAYLOAD-TRAILER"
+EMPTY_SHA256 = sha256(b"").hexdigest()
+MAX_CHUNK_HEADER = 4096
+sha256_pattern = compile("^[0-9a-f]{64}$")
+
+class PayloadMismatch(Exception):
+    pass
+
+class ChunkSignatureMismatch(PayloadMismatch):
+    pass
+
+class UnsupportedPayload(Exception):
+    pass
+
+def _sign(key, msg):
+    return new(key, msg.encode('utf-8'), sha256).digest()
+
+@lru_cache(maxsize=4096)
+def signing_key(key, datestamp, region, service):
+    kDate = _sign(('AWS4' + key).encode('utf-8'), datestamp)
+    kRegion = _sign(kDate, region)
+    kService = _sign(kRegion, service)
+    kSigning = _sign(kService, 'aws4_request')
+    return kSigning
 
 class SignatureV4:
     def __init__(self, request):
         self.userId = None
         self._valid = True
         self.verified = False
+        self.key = None
         self._request = request
         if not (auth := request.headers.get("Authorization")):
             self._valid = False
@@ -24,15 +55,8 @@ class SignatureV4:
         self.signature = sig
         self.amzdate = request.headers.get("x-amz-date")
 
-    def _sign(self, key, msg):
-        return new(key, msg.encode('utf-8'), sha256).digest()
-
     def _getSignatureKey(self, key):
-        kDate = self._sign(('AWS4' + key).encode('utf-8'), self.datestamp)
-        kRegion = self._sign(kDate, self.region)
-        kService = self._sign(kRegion, self.service)
-        kSigning = self._sign(kService, 'aws4_request')
-        return kSigning
+        return signing_key(key, self.datestamp, self.region, self.service)
 
     def _getQueryString(self):
         
@@ -67,5 +91,77 @@ class SignatureV4:
         s = f'AWS4-HMAC-SHA256\n{self.amzdate}\n{self.datestamp}/{self.region}/{self.service}/aws4_request\n{sha256(req).hexdigest()}'
         key = self._getSignatureKey(key)
         signature = new(key, s.encode('utf-8'), sha256).hexdigest()
-        self.verified = signature == self.signature
-        return self.verified
\ No newline at end of file
+        self.verified = compare_digest(signature, self.signature)
+        if self.verified:
+            self.key = key
+        return self.verified
+
+    def payload(self, chunks):
+        content_sha256 = self._request.headers.get("x-amz-content-sha256")
+        if content_sha256 in (None, UNSIGNED_PAYLOAD):
+            return chunks
+        if content_sha256 == STREAMING_PAYLOAD:
+            return self._chunked(chunks, signed=True)
+        if content_sha256 == STREAMING_UNSIGNED_TRAILER:
+            return self._chunked(chunks, signed=False)
+        if sha256_pattern.match(content_sha256):
+            return self._hashed(chunks, content_sha256)
+        raise UnsupportedPayload(content_sha256)
+
+    async def _hashed(self, chunks, expected):
+        checksum = sha256()
+        async for chunk in chunks:
+            await update_digests(chunk, checksum)
+            yield chunk
+        if checksum.hexdigest() != expected:
+            raise PayloadMismatch
+
+    async def _chunked(self, chunks, signed):
+        chunks = chunks.__aiter__()
+        buf = bytearray()
+
+        async def fill(size):
+            nonlocal buf
+            while len(buf) < size:
+                try:
+                    buf += await chunks.__anext__()
+                except StopAsyncIteration:
+                    raise PayloadMismatch("truncated aws-chunked body")
+
+        async def line():
+            while (end := buf.find(b"\r\n")) == -1:
+                if len(buf) > MAX_CHUNK_HEADER:
+                    raise PayloadMismatch("malformed aws-chunked body")
+                await fill(len(buf) + 1)
+            data = bytes(buf[:end])
+            del buf[:end + 2]
+            return data.decode("latin-1")
+
+        scope = f"{self.datestamp}/{self.region}/{self.service}/aws4_request"
+        previous = self.signature
+        while True:
+            size, _, extensions = (await line()).partition(";")
+            try:
+                size = int(size, 16)
+            except ValueError:
+                raise PayloadMismatch("malformed aws-chunked body")
+            if size:
+                await fill(size + 2)
+                data = bytes(buf[:size])
+                if buf[size:size + 2] != b"\r\n":
+                    raise PayloadMismatch("malformed aws-chunked body")
+                del buf[:size + 2]
+            else:
+                data = b""
+            if signed:
+                checksum = sha256()
+                await update_digests(data, checksum)
+                s = f"AWS4-HMAC-SHA256-PAYLOAD\n{self.amzdate}\n{scope}\n{previous}\n{EMPTY_SHA256}\n{checksum.hexdigest()}"
+                previous = new(self.key, s.encode("utf-8"), sha256).hexdigest()
+                if not compare_digest(previous, extensions.partition("chunk-signature=")[2]):
+                    raise ChunkSignatureMismatch
+            if not size:
+                break
+            yield data
+        while await line():
+            pass
\ No newline at end of file
@@ -0,0 +1,429 @@
+from bisect import bisect_left, bisect_right, insort
+from copy import deepcopy
+from functools import lru_cache
+from itertools import count
+from re import compile, escape, sub
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+# Ordered single-field indexes, mirroring the ones setup_database.py creates.
+INDEXES = {
+    "users": ("id",),
+    "buckets": ("name", "owner"),
+    "objects": ("name", "uploadId"),
+    "blobs": ("sha256",),
+    "upload_parts": ("uploadId",),
+}
+
+TOP = (float("inf"),)
+
+def _rank(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return 0
+    if isinstance(value, str):
+        return 1
+    return None
+
+@lru_cache(maxsize=1024)
+def _regex(pattern):
+    return compile(pattern)
+
+def _literalPrefix(pattern):
+    if not pattern.startswith("^"):
+        return None
+    prefix = sub(r"\\(.)", r"\1", pattern[1:])
+    return prefix if escape(prefix) == pattern[1:] else None
+
+def _values(doc, path):
+    values = [doc]
+    for key in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if key in value:
+                    found.append(value[key])
+            elif isinstance(value, list):
+                if key.isdigit():
+                    if int(key) < len(value):
+                        found.append(value[int(key)])
+                else:
+                    found += [v[key] for v in value if isinstance(v, dict) and key in v]
+        values = found
+    return values
+
+def _flatten(values):
+    return values + [v for value in values if isinstance(value, list) for v in value]
+
+def _compare(value, op, arg):
+    if _rank(value) is None or _rank(value) != _rank(arg):
+        return False
+    if op == "$gt":
+        return value > arg
+    if op == "$gte":
+        return value >= arg
+    if op == "$lt":
+        return value < arg
+    return value <= arg
+
+def _operator(values, op, arg):
+    if op == "$exists":
+        return bool(values) == bool(arg)
+    if op == "$ne":
+        return not any(v == arg for v in _flatten(values))
+    if op == "$in":
+        return any(v in arg for v in _flatten(values) if not isinstance(v, (dict, list)))
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        return any(_compare(v, op, arg) for v in _flatten(values))
+    if op == "$regex":
+        return any(isinstance(v, str) and _regex(arg).search(v) for v in _flatten(values))
+    if op == "$type":
+        if arg != "string":
+            raise NotImplementedError(f"$type {arg}")
+        return any(isinstance(v, str) for v in _flatten(values))
+    if op == "$elemMatch":
+        return any(isinstance(e, dict) and _match(e, arg) for v in values if isinstance(v, list) for e in v)
+    raise NotImplementedError(op)
+
+def _isOperator(cond):
+    return isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond)
+
+def _match(doc, query):
+    for path, cond in query.items():
+        if path.startswith("$"):
+            raise NotImplementedError(path)
+        values = _values(doc, path)
+        if _isOperator(cond):
+            if not all(_operator(values, op, arg) for op, arg in cond.items()):
+                return False
+        elif not any(v == cond for v in _flatten(values)):
+            return False
+    return True
+
+def _set(doc, path, value):
+    *parents, key = path.split(".")
+    for parent in parents:
+        doc = doc.setdefault(parent, {})
+    doc[key] = value
+
+def _unset(doc, path):
+    *parents, key = path.split(".")
+    for parent in parents:
+        if not isinstance(doc := doc.get(parent), dict):
+            return
+    doc.pop(key, None)
+
+def _apply(doc, update, insert=False):
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if "$" in path:
+                raise NotImplementedError(f"positional update {path}")
+            if op == "$set" or (op == "$setOnInsert" and insert):
+                _set(doc, path, deepcopy(value))
+            elif op == "$inc":
+                _set(doc, path, (_values(doc, path) or [0])[0] + value)
+            elif op == "$unset":
+                _unset(doc, path)
+            elif op != "$setOnInsert":
+                raise NotImplementedError(op)
+
+def _project(doc, projection):
+    if not projection:
+        return deepcopy(doc)
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if any(fields.values()) or (not fields and projection["_id"]):
+        result = {k: deepcopy(doc[k]) for k in fields if k in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return {k: deepcopy(v) for k, v in doc.items() if projection.get(k, 1)}
+
+def _sortKey(doc, field):
+    values = _values(doc, field)
+    if not values or (rank := _rank(values[0])) is None:
+        return (-1, 0)
+    return (rank, values[0])
+
+class InsertResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+class UpdateResult:
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+class DeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+class Cursor:
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self._sort = None
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key, direction=1):
+        self._sort = (key, direction)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._results is None:
+            self._results = iter(self.collection._find(self.query, self.projection, self._sort, self._limit))
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        if length and (not self._limit or length < self._limit):
+            self._limit = length
+        return [doc async for doc in self]
+
+class Collection:
+    """In-memory collection implementing the subset of the Motor API used by the server."""
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.ids = {}
+        self.indexes = {field: [] for field in INDEXES.get(name, ())}
+        self.seq = count()
+
+    def _entries(self, seq, doc):
+        for field, keys in self.indexes.items():
+            if (rank := _rank(value := doc.get(field))) is not None:
+                yield keys, (rank, value, seq)
+
+    def _index(self, seq, doc):
+        for keys, entry in self._entries(seq, doc):
+            insort(keys, entry)
+
+    def _unindex(self, seq, doc):
+        for keys, entry in self._entries(seq, doc):
+            if (i := bisect_left(keys, entry)) < len(keys) and keys[i] == entry:
+                del keys[i]
+
+    def _add(self, doc):
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self.ids:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} dup key: {doc['_id']}")
+        seq = self.ids[doc["_id"]] = next(self.seq)
+        self.docs[seq] = doc
+        return seq
+
+    def _remove(self, seq):
+        doc = self.docs.pop(seq)
+        del self.ids[doc["_id"]]
+        self._unindex(seq, doc)
+        return doc
+
+    def _range(self, keys, cond):
+        if not _isOperator(cond):
+            if (rank := _rank(cond)) is None:
+                return None
+            return [e[2] for e in keys[bisect_left(keys, (rank, cond)):bisect_right(keys, (rank, cond) + TOP)]]
+        lower = [(op, arg) for op, arg in cond.items() if op in ("$gt", "$gte")]
+        prefix = _literalPrefix(cond["$regex"]) if "$regex" in cond else None
+        if not lower and prefix is None:
+            return None
+        start, rank = 0, 1 if prefix is not None else _rank(lower[0][1])
+        for op, arg in lower:
+            if _rank(arg) != rank:
+                return None
+            start = max(start, bisect_right(keys, (rank, arg) + TOP) if op == "$gt" else bisect_left(keys, (rank, arg)))
+        if prefix is not None:
+            start = max(start, bisect_left(keys, (rank, prefix)))
+        return self._walk(keys, start, rank, prefix)
+
+    def _walk(self, keys, i, rank, prefix):
+        while i < len(keys) and keys[i][0] == rank and (prefix is None or keys[i][1].startswith(prefix)):
+            yield keys[i][2]
+            i += 1
+
+    def _plan(self, query, sort):
+        if "_id" in query:
+            cond = query["_id"]
+            if not isinstance(cond, dict):
+                return [s for s in [self.ids.get(cond)] if s is not None], sort is None
+            if set(cond) == {"$in"}:
+                return [s for i in cond["$in"] if (s := self.ids.get(i)) is not None], sort is None
+        for field, keys in self.indexes.items():
+            if field in query and (seqs := self._range(keys, query[field])) is not None:
+                return seqs, sort is None or sort == (field, 1)
+        return list(self.docs), sort is None
+
+    def _find(self, query, projection=None, sort=None, limit=0):
+        seqs, ordered = self._plan(query, sort)
+        results = []
+        for seq in seqs:
+            if (doc := self.docs.get(seq)) is not None and _match(doc, query):
+                results.append(doc)
+                if ordered and limit and len(results) == limit:
+                    break
+        if not ordered:
+            results.sort(key=lambda d: _sortKey(d, sort[0]), reverse=sort[1] < 0)
+        if limit:
+            results = results[:limit]
+        return [_project(d, projection) for d in results]
+
+    def _first(self, query):
+        seqs, _ = self._plan(query, None)
+        for seq in seqs:
+            if (doc := self.docs.get(seq)) is not None and _match(doc, query):
+                return seq, doc
+        return None, None
+
+    def _upsert(self, query, update):
+        doc = {k: deepcopy(v) for k, v in query.items() if not k.startswith("$") and "." not in k and not _isOperator(v)}
+        _apply(doc, update, insert=True)
+        seq = self._add(doc)
+        self._index(seq, doc)
+        return doc
+
+    def _update(self, seq, doc, update):
+        self._unindex(seq, doc)
+        _apply(doc, update)
+        self._index(seq, doc)
+
+    def find(self, query=None, projection=None):
+        return Cursor(self, query or {}, projection)
+
+    async def find_one(self, query=None, projection=None):
+        results = self._find(query or {}, projection, None, 1)
+        return results[0] if results else None
+
+    async def insert_one(self, doc):
+        stored = deepcopy(doc)
+        seq = self._add(stored)
+        self._index(seq, stored)
+        doc["_id"] = stored["_id"]
+        return InsertResult(doc["_id"])
+
+    async def insert_many(self, docs):
+        docs = list(docs)
+        seqs = [self._add(doc) for doc in docs]
+        for seq, doc in zip(seqs, docs):
+            for keys, entry in self._entries(seq, doc):
+                keys.append(entry)
+        for keys in self.indexes.values():
+            keys.sort()
+        return [doc["_id"] for doc in docs]
+
+    async def update_one(self, query, update, upsert=False):
+        seq, doc = self._first(query)
+        if doc is None:
+            if upsert:
+                return UpdateResult(0, 0, self._upsert(query, update)["_id"])
+            return UpdateResult(0, 0)
+        self._update(seq, doc, update)
+        return UpdateResult(1, 1)
+
+    async def update_many(self, query, update):
+        seqs, _ = self._plan(query, None)
+        matched = [(seq, doc) for seq in list(seqs) if (doc := self.docs.get(seq)) is not None and _match(doc, query)]
+        for seq, doc in matched:
+            self._update(seq, doc, update)
+        return UpdateResult(len(matched), len(matched))
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False):
+        seq, doc = self._first(query)
+        if doc is None:
+            if upsert:
+                self._upsert(query, update)
+            return None
+        old = _project(doc, projection)
+        self._update(seq, doc, update)
+        return old
+
+    async def find_one_and_replace(self, query, replacement, projection=None, upsert=False):
+        seq, doc = self._first(query)
+        if doc is None:
+            if upsert:
+                await self.insert_one(deepcopy(replacement))
+            return None
+        old = _project(doc, projection)
+        self._unindex(seq, doc)
+        _id = doc["_id"]
+        doc.clear()
+        doc.update(deepcopy(replacement), _id=_id)
+        self._index(seq, doc)
+        return old
+
+    async def find_one_and_delete(self, query, projection=None):
+        seq, doc = self._first(query)
+        if doc is None:
+            return None
+        return _project(self._remove(seq), projection)
+
+    async def delete_one(self, query):
+        seq, doc = self._first(query)
+        if doc is None:
+            return DeleteResult(0)
+        self._remove(seq)
+        return DeleteResult(1)
+
+    async def delete_many(self, query):
+        seqs, _ = self._plan(query, None)
+        matched = [seq for seq in list(seqs) if (doc := self.docs.get(seq)) is not None and _match(doc, query)]
+        for seq in matched:
+            self._remove(seq)
+        return DeleteResult(len(matched))
+
+    async def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            await self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    async def distinct(self, key, query=None):
+        result = []
+        for doc in self._find(query or {}):
+            for value in _flatten(_values(doc, key)):
+                if not isinstance(value, list) and value not in result:
+                    result.append(value)
+        return result
+
+    async def count_documents(self, query):
+        return len(self._find(query))
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    def watch(self, *args, **kwargs):
+        raise NotImplementedError("change streams are not available in the benchmark database")
+
+class Database:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = Collection(name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+class MotorClient:
+    """Stands in for AsyncIOMotorClient; every database name maps to the same in-memory database."""
+
+    def __init__(self, *args, **kwargs):
+        self.database = Database()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.database
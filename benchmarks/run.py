@@ -0,0 +1,334 @@
+"""Offline benchmarks: runs main.py against in-process telegram and MongoDB stand-ins.
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --output after.json --compare before.json
+"""
+from asyncio import create_task, gather, open_connection, run, sleep
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from hashlib import md5, sha256
+from hmac import new
+from json import dump, load
+from os import environ
+from random import Random
+from statistics import mean, median
+from subprocess import run as run_process
+from time import perf_counter
+from types import SimpleNamespace
+import platform
+import socket
+import sys
+
+ACCESS_KEY = "benchmark"
+SECRET_KEY = "benchmark-secret"
+REGION = "us-east-1"
+SETTINGS = ["DOWNLOAD_PREFETCH", "MEDIA_SESSIONS_PER_DC", "OBJECT_PART_SIZE", "UPLOAD_WORKERS", "DEDUP", "PACK_THRESHOLD", "CACHE_DIR", "CACHE_SIZE", "CACHE_UPLOADS", "USER_CACHE_TTL", "BUCKET_CACHE_TTL"]
+
+def parseSize(value):
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    value = value.strip().lower().rstrip("ib")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def summary(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "min": values[0],
+        "median": median(values),
+        "p95": values[min(len(values) - 1, round(0.95 * (len(values) - 1)))],
+        "max": values[-1],
+        "mean": mean(values)
+    }
+
+def sign(method, path, query, headers, payload_hash, now=None):
+    from auth import signing_key
+    now = now or datetime.now(timezone.utc)
+    amzdate = now.strftime("%Y%m%dT%H%M%SZ")
+    datestamp = now.strftime("%Y%m%d")
+    headers["x-amz-date"] = amzdate
+    headers["x-amz-content-sha256"] = payload_hash
+    signed = sorted(h for h in headers if h == "host" or h.startswith("x-amz-"))
+    canonical_query = "&".join(sorted(f"{k}={v}" for k, _, v in [p.partition("=") for p in query.split("&")])) if query else ""
+    canonical = "\n".join([method, path, canonical_query, "".join(f"{h}:{headers[h]}\n" for h in signed), ";".join(signed), payload_hash])
+    scope = f"{datestamp}/{REGION}/s3/aws4_request"
+    string_to_sign = f"AWS4-HMAC-SHA256\n{amzdate}\n{scope}\n{sha256(canonical.encode('utf-8')).hexdigest()}"
+    signature = new(signing_key(SECRET_KEY, datestamp, REGION, "s3"), string_to_sign.encode("utf-8"), sha256).hexdigest()
+    headers["Authorization"] = f"AWS4-HMAC-SHA256 Credential={ACCESS_KEY}/{scope}, SignedHeaders={';'.join(signed)}, Signature={signature}"
+    return headers
+
+class HTTPClient:
+    """Minimal HTTP/1.1 client that signs requests and times the first body byte."""
+
+    def __init__(self, host, port, sign_payload=False):
+        self.host = host
+        self.port = port
+        self.sign_payload = sign_payload
+
+    async def request(self, method, path, query="", body=b"", headers=None, payload_hash=None):
+        headers = {"host": f"{self.host}:{self.port}", **(headers or {})}
+        if payload_hash is None:
+            payload_hash = sha256(body).hexdigest() if self.sign_payload else "UNSIGNED-PAYLOAD"
+        sign(method, path, query, headers, payload_hash)
+        headers["Content-Length"] = str(len(body))
+        headers["Connection"] = "close"
+        target = f"{path}?{query}" if query else path
+        start = perf_counter()
+        reader, writer = await open_connection(self.host, self.port)
+        try:
+            writer.write(f"{method} {target} HTTP/1.1\r\n".encode() + "".join(f"{k}: {v}\r\n" for k, v in headers.items()).encode() + b"\r\n")
+            if body:
+                writer.write(body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            response_headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+            checksum = md5()
+            size = 0
+            ttfb = None
+            async for data in self._body(reader, response_headers, method == "HEAD"):
+                if ttfb is None:
+                    ttfb = perf_counter() - start
+                checksum.update(data)
+                size += len(data)
+            elapsed = perf_counter() - start
+        finally:
+            writer.close()
+        return SimpleNamespace(status=status, headers=response_headers, size=size, md5=checksum.hexdigest(), ttfb=ttfb if ttfb is not None else elapsed, elapsed=elapsed)
+
+    async def _body(self, reader, headers, head):
+        if head:
+            return
+        if headers.get("transfer-encoding") == "chunked":
+            while (size := int((await reader.readline()).split(b";")[0], 16)):
+                while size:
+                    data = await reader.readexactly(min(size, 65536))
+                    size -= len(data)
+                    yield data
+                await reader.readline()
+            await reader.readline()
+        elif (length := headers.get("content-length")) is not None:
+            remaining = int(length)
+            while remaining and (data := await reader.read(min(remaining, 65536))):
+                remaining -= len(data)
+                yield data
+        else:
+            while (data := await reader.read(65536)):
+                yield data
+
+async def timed(n, concurrency, fn):
+    results = []
+    for _ in range(n):
+        start = perf_counter()
+        batch = await gather(*[fn(i) for i in range(concurrency)])
+        results.append((perf_counter() - start, batch))
+    return results
+
+async def benchObjects(client, sizes, repeat, concurrency, seed):
+    report = {}
+    random = Random(seed)
+    await client.request("PUT", "/bench-objects")
+    for size in sizes:
+        body = random.randbytes(size)
+        expected = md5(body).hexdigest()
+        payload_hash = sha256(body).hexdigest() if client.sign_payload else None
+        key = f"/bench-objects/object-{size}"
+
+        async def put(i):
+            return await client.request("PUT", f"{key}-{i}", body=body, payload_hash=payload_hash)
+
+        async def get(i):
+            return await client.request("GET", f"{key}-{i}")
+
+        async def rangeGet(i):
+            return await client.request("GET", f"{key}-{i}", headers={"Range": f"bytes={size // 2}-{min(size // 2 + 65535, size - 1)}"})
+
+        async def head(i):
+            return await client.request("HEAD", f"{key}-{i}")
+
+        puts = await timed(repeat, concurrency, put)
+        gets = await timed(repeat, concurrency, get)
+        ranges = await timed(repeat, concurrency, rangeGet) if size else []
+        heads = await timed(repeat, concurrency, head)
+        responses = [r for _, batch in puts + gets + ranges + heads for r in batch]
+        report[str(size)] = {
+            "put_mib_s": summary([size * concurrency / wall / 2 ** 20 for wall, _ in puts]),
+            "put_latency_s": summary([r.elapsed for _, batch in puts for r in batch]),
+            "get_mib_s": summary([size * concurrency / wall / 2 ** 20 for wall, _ in gets]),
+            "get_ttfb_s": summary([r.ttfb for _, batch in gets for r in batch]),
+            "range_ttfb_s": summary([r.ttfb for _, batch in ranges for r in batch]),
+            "head_latency_s": summary([r.elapsed for _, batch in heads for r in batch]),
+            "errors": sum(r.status >= 300 for r in responses),
+            "corrupt": sum(r.md5 != expected or r.size != size for _, batch in gets for r in batch)
+        }
+        print(f"objects {size}: {report[str(size)]['get_mib_s'].get('median', 0):.1f} MiB/s GET", file=sys.stderr)
+    return report
+
+async def benchListing(client, mongo, sizes, repeat, page_size):
+    report = {}
+    for n in sizes:
+        bucket = f"bench-list-{n}"
+        await client.request("PUT", f"/{bucket}")
+        names = [f"dir-{i % 100:03d}/file-{i:07d}" for i in range(n)]
+        await mongo.objects.insert_many({
+            "name": name,
+            "owner": ACCESS_KEY,
+            "time": 0,
+            "size": 0,
+            "mime_type": "application/octet-stream",
+            "bucket": bucket,
+            "hash": "d41d8cd98f00b204e9800998ecf8427e",
+            "parts": []
+        } for name in names)
+        names.sort()
+        queries = {
+            "first_page": f"list-type=2&max-keys={page_size}",
+            "middle_page": f"list-type=2&max-keys={page_size}&start-after={names[n // 2]}",
+            "prefix": f"list-type=2&max-keys={page_size}&prefix=dir-042%2F",
+            "delimiter": f"list-type=2&max-keys={page_size}&delimiter=%2F",
+            "v1_marker": f"max-keys={page_size}&marker={names[n // 2]}"
+        }
+        report[str(n)] = {}
+        for name, query in queries.items():
+            responses = [await client.request("GET", f"/{bucket}", query) for _ in range(repeat)]
+            report[str(n)][name] = summary([r.elapsed for r in responses])
+            report[str(n)][name]["errors"] = sum(r.status != 200 for r in responses)
+        await mongo.objects.delete_many({"bucket": bucket})
+        print(f"listing {n}: {report[str(n)]['first_page']['median'] * 1000:.1f} ms first page", file=sys.stderr)
+    return report
+
+def benchSignature(iterations):
+    from auth import SignatureV4, signing_key
+    headers = sign("GET", "/bench/key", "list-type=2&prefix=a", {"host": "127.0.0.1:8000"}, "UNSIGNED-PAYLOAD")
+    request = SimpleNamespace(method="GET", path="/bench/key", query_string=b"list-type=2&prefix=a", headers=headers)
+    assert SignatureV4(request).verify(SECRET_KEY)
+    report = {}
+    for name, prepare in (("warm", lambda: None), ("cold", signing_key.cache_clear)):
+        start = perf_counter()
+        for _ in range(iterations):
+            prepare()
+            SignatureV4(request).verify(SECRET_KEY)
+        report[f"verify_{name}_us"] = (perf_counter() - start) / iterations * 1e6
+    return report
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def gitRevision():
+    try:
+        return run_process(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def flatten(data, prefix=""):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+def compare(old, new):
+    old = dict(flatten(old["results"]))
+    for key, value in flatten(new["results"]):
+        if key in old:
+            change = f"{(value - old[key]) / old[key] * 100:+.1f}%" if old[key] else "n/a"
+            print(f"{key:<60} {old[key]:>14.6g} {value:>14.6g} {change:>9}")
+
+async def benchmark(args):
+    from benchmarks.mongo import MotorClient
+    from benchmarks.telegram import FakeTelegram, install
+    server = FakeTelegram(args.latency, args.bandwidth, args.max_chunk, args.flood_rate, args.flood_wait, args.seed)
+    install(server)
+    import main
+    from uvicorn import Config, Server
+    motor = MotorClient()
+    main.AsyncIOMotorClient = lambda *a, **kw: motor
+    await motor.s3.users.insert_one({"id": ACCESS_KEY, "key": SECRET_KEY, "name": "benchmark"})
+    port = freePort()
+    http = Server(Config(main.app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    serving = create_task(http.serve())
+    while not http.started:
+        if serving.done():
+            serving.result()
+            raise RuntimeError("server did not start")
+        await sleep(0.01)
+    client = HTTPClient("127.0.0.1", port, args.sign_payload)
+    results = {}
+    try:
+        if not args.skip_objects:
+            results["objects"] = await benchObjects(client, args.sizes, args.repeat, args.concurrency, args.seed)
+        if not args.skip_listing:
+            results["listing"] = await benchListing(client, motor.s3, args.list_sizes, args.repeat, args.page_size)
+        results["signature"] = benchSignature(args.signature_iterations)
+    finally:
+        http.should_exit = True
+        await serving
+    return {
+        "version": 1,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": gitRevision(),
+        "python": platform.python_version(),
+        "config": {
+            "telegram": {"latency": args.latency, "bandwidth": args.bandwidth, "max_chunk": args.max_chunk, "flood_rate": args.flood_rate, "flood_wait": args.flood_wait, "bots": args.bots},
+            "sizes": args.sizes,
+            "list_sizes": args.list_sizes,
+            "repeat": args.repeat,
+            "concurrency": args.concurrency,
+            "sign_payload": args.sign_payload,
+            "env": {name: environ[name] for name in SETTINGS if name in environ}
+        },
+        "telegram": dict(server.stats),
+        "results": results
+    }
+
+def main():
+    parser = ArgumentParser(description="Benchmark the server against in-process telegram and MongoDB stand-ins.")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="print the change of every metric relative to this earlier report")
+    parser.add_argument("--sizes", type=lambda v: [parseSize(s) for s in v.split(",")], default="64k,1m,16m,64m", help="object sizes for PUT/GET benchmarks")
+    parser.add_argument("--list-sizes", type=lambda v: [parseSize(s) for s in v.split(",")], default="10k,100k,1m", help="numbers of keys for listing benchmarks")
+    parser.add_argument("--page-size", type=int, default=1000, help="max-keys used for listing requests")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions of every measurement")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent requests per PUT/GET measurement")
+    parser.add_argument("--signature-iterations", type=int, default=10000, help="iterations of SignatureV4.verify")
+    parser.add_argument("--sign-payload", action="store_true", help="send the SHA-256 of request bodies instead of UNSIGNED-PAYLOAD")
+    parser.add_argument("--skip-objects", action="store_true", help="skip the PUT/GET benchmarks")
+    parser.add_argument("--skip-listing", action="store_true", help="skip the listing benchmarks")
+    parser.add_argument("--bots", type=int, default=1, help="number of fake bots")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every telegram RPC")
+    parser.add_argument("--bandwidth", type=parseSize, default="0", help="telegram bandwidth per RPC in bytes per second, 0 for unlimited")
+    parser.add_argument("--max-chunk", type=parseSize, default="1m", help="most bytes a single GetFile returns")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of telegram RPCs failing with FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=1, help="seconds of every injected FloodWait")
+    parser.add_argument("--cache-dir", help="enable the chunk cache in this directory")
+    parser.add_argument("--seed", type=int, default=0, help="seed for generated data and injected failures")
+    args = parser.parse_args()
+    environ.update({
+        "BOT_TOKENS": ",".join(f"benchmark-{i}" for i in range(args.bots)),
+        "API_ID": "1",
+        "API_HASH": "benchmark",
+        "CHAT_ID": "-1000000000001",
+        "MONGODB": "memory",
+        "GC_INTERVAL": "0",
+        "BUCKET_CACHE_WATCH": "",
+        "CACHE_DIR": args.cache_dir or ""
+    })
+    report = run(benchmark(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            dump(report, f, indent=2)
+    else:
+        dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(load(f), report)
+
+if __name__ == "__main__":
+    main()
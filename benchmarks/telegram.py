@@ -0,0 +1,185 @@
+from asyncio import Event, sleep
+from collections import Counter
+from datetime import datetime
+from functools import partial
+from itertools import count
+from random import Random
+from types import SimpleNamespace
+from pyrogram.errors import FloodWait, LimitInvalid, OffsetInvalid, FilePartMissing, FileIdInvalid
+from pyrogram.file_id import FileId, FileType
+from pyrogram.raw.functions.upload import GetFile, SaveFilePart, SaveBigFilePart
+from pyrogram.raw.functions.messages import SendMedia
+from pyrogram.raw.types import UpdateNewChannelMessage
+
+DC_ID = 2
+MAX_PART_SIZE = 512 * 1024
+MAX_LIMIT = 1024 * 1024
+
+class FakeTelegram:
+    """In-process stand-in for the telegram servers the bots talk to.
+
+    Every RPC costs `latency` seconds plus its payload divided by `bandwidth` (bytes per second, 0 for
+    unlimited). A fraction `flood_rate` of RPCs fails with FloodWait(`flood_wait`). GetFile enforces
+    telegram's offset/limit rules and never returns more than `max_chunk` bytes.
+    """
+
+    def __init__(self, latency=0.05, bandwidth=0, max_chunk=MAX_LIMIT, flood_rate=0.0, flood_wait=1, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_chunk = max_chunk
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.random = Random(seed)
+        self.ids = count(1)
+        self.bots = {}
+        self.uploads = {}
+        self.documents = {}
+        self.messages = {}
+        self.stats = Counter()
+
+    def rnd_id(self):
+        return self.random.getrandbits(63)
+
+    def bot_id(self, name):
+        return self.bots.setdefault(name, 1000 + len(self.bots))
+
+    async def rpc(self, method, size=0):
+        self.stats[f"rpc.{method}"] += 1
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.stats["flood_waits"] += 1
+            raise FloodWait(value=self.flood_wait)
+        await sleep(self.latency + (size / self.bandwidth if self.bandwidth else 0))
+
+    async def invoke(self, client, query):
+        if isinstance(query, GetFile):
+            await self.rpc("GetFile", min(query.limit, self.max_chunk))
+            return self.getFile(query)
+        if isinstance(query, (SaveFilePart, SaveBigFilePart)):
+            await self.rpc(type(query).__name__, len(query.bytes))
+            return self.saveFilePart(client, query)
+        if isinstance(query, SendMedia):
+            await self.rpc("SendMedia")
+            return self.sendMedia(client, query)
+        raise NotImplementedError(type(query).__name__)
+
+    def getFile(self, query):
+        offset, limit = query.offset, query.limit
+        if limit <= 0 or limit % 4096 or MAX_LIMIT % limit or limit > MAX_LIMIT:
+            raise LimitInvalid()
+        if offset % 4096 or offset // MAX_LIMIT != (offset + limit - 1) // MAX_LIMIT:
+            raise OffsetInvalid()
+        if (data := self.documents.get(query.location.id)) is None:
+            raise FileIdInvalid()
+        chunk = data[offset:offset + min(limit, self.max_chunk)]
+        self.stats["bytes_downloaded"] += len(chunk)
+        return SimpleNamespace(bytes=chunk)
+
+    def saveFilePart(self, client, query):
+        if len(query.bytes) > MAX_PART_SIZE:
+            raise LimitInvalid()
+        self.uploads.setdefault((client.name, query.file_id), {})[query.file_part] = query.bytes
+        self.stats["bytes_uploaded"] += len(query.bytes)
+        return True
+
+    def sendMedia(self, client, query):
+        file = query.media.file
+        parts = self.uploads.pop((client.name, file.id), {})
+        if (missing := [i for i in range(file.parts) if i not in parts]):
+            raise FilePartMissing(value=missing[0])
+        media_id = next(self.ids)
+        self.documents[media_id] = data = b"".join([parts[i] for i in range(file.parts)])
+        file_id = FileId(file_type=FileType.DOCUMENT, dc_id=DC_ID, media_id=media_id, access_hash=self.rnd_id(), file_reference=b"").encode()
+        message = SimpleNamespace(
+            id=media_id,
+            empty=False,
+            date=datetime.now(),
+            document=SimpleNamespace(file_id=file_id, file_size=len(data))
+        )
+        self.messages[message.id] = message
+        return SimpleNamespace(updates=[UpdateNewChannelMessage(message=message, pts=0, pts_count=0)], users=[], chats=[])
+
+class Storage:
+    async def dc_id(self):
+        return DC_ID
+
+    async def test_mode(self):
+        return False
+
+    async def auth_key(self):
+        return bytes(256)
+
+class Client:
+    def __init__(self, server, name, **kwargs):
+        self.server = server
+        self.name = name
+        self.storage = Storage()
+        self.media_sessions = {}
+
+    def rnd_id(self):
+        return self.server.rnd_id()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def get_me(self):
+        return SimpleNamespace(id=self.server.bot_id(self.name))
+
+    async def resolve_peer(self, peer_id):
+        return peer_id
+
+    async def invoke(self, query):
+        return await self.server.invoke(self, query)
+
+    async def get_messages(self, chat_id, message_ids):
+        ids = message_ids if isinstance(message_ids, list) else [message_ids]
+        await self.server.rpc("GetMessages")
+        empty = SimpleNamespace(empty=True, document=None)
+        messages = [self.server.messages.get(i, SimpleNamespace(id=i, **vars(empty))) for i in ids]
+        return messages if isinstance(message_ids, list) else messages[0]
+
+    async def delete_messages(self, chat_id, message_ids):
+        await self.server.rpc("DeleteMessages")
+        deleted = 0
+        for i in message_ids if isinstance(message_ids, list) else [message_ids]:
+            if self.server.messages.pop(i, None):
+                self.server.documents.pop(i, None)
+                deleted += 1
+        return deleted
+
+class Session:
+    def __init__(self, client, dc_id, auth_key, test_mode, is_media=False):
+        self.client = client
+        self.is_started = Event()
+
+    async def start(self):
+        self.is_started.set()
+
+    async def stop(self):
+        self.is_started.clear()
+
+    async def invoke(self, query):
+        return await self.client.server.invoke(self.client, query)
+
+class Auth:
+    def __init__(self, client, dc_id, test_mode):
+        pass
+
+    async def create(self):
+        return bytes(256)
+
+class Message:
+    @staticmethod
+    async def _parse(client, message, users, chats):
+        return message
+
+def install(server):
+    """Route every telegram call made by bots.py and tg.py to `server`."""
+    import bots
+    import tg
+    bots.Client = partial(Client, server)
+    tg.Session = Session
+    tg.Auth = Auth
+    tg.Message = Message
@@ -0,0 +1,59 @@
+from collections import Counter
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+DELETE_BATCH = 100
+
+async def deleteMessages(bots, messages):
+    for i in range(0, len(messages), DELETE_BATCH):
+        await bots.delete_messages(messages[i:i + DELETE_BATCH])
+
+def _changes(parts, sign):
+    counts = Counter(p["tg_message"] for p in parts)
+    packed = Counter()
+    for p in parts:
+        if "base" in p:
+            packed[p["tg_message"]] += p["size"]
+    changes = {}
+    for m, n in counts.items():
+        changes[m] = {"refs": sign * n}
+        if packed[m]:
+            changes[m]["live"] = sign * packed[m]
+    return counts, changes
+
+async def releaseParts(mongo, bots, parts):
+    counts, changes = _changes(parts, -1)
+    if not counts:
+        return []
+    await mongo.blobs.bulk_write([UpdateOne({"_id": m}, {"$inc": inc}) for m, inc in changes.items()], ordered=False)
+    tracked = set()
+    messages = []
+    async for blob in mongo.blobs.find({"_id": {"$in": list(counts)}}, {"refs": 1}):
+        tracked.add(blob["_id"])
+        if blob["refs"] <= 0:
+            messages.append(blob["_id"])
+    messages += [m for m in counts if m not in tracked]
+    await mongo.blobs.delete_many({"_id": {"$in": messages}, "refs": {"$lte": 0}})
+    await deleteMessages(bots, messages)
+    return messages
+
+async def claimUploadParts(mongo, query):
+    # Whoever deletes an upload_parts row owns its documents, so concurrent cleanups never release them twice.
+    documents = []
+    async for row in mongo.upload_parts.find(query, {"_id": 1}):
+        if (row := await mongo.upload_parts.find_one_and_delete({"_id": row["_id"]}, {"documents": 1})):
+            documents += row["documents"]
+    return documents
+
+async def retainParts(mongo, bots, parts):
+    retained = []
+    counts, changes = _changes(parts, 1)
+    for m, n in counts.items():
+        if not await mongo.blobs.find_one_and_update({"_id": m, "refs": {"$gt": 0}}, {"$inc": changes[m]}):
+            try:
+                await mongo.blobs.insert_one({"_id": m, "refs": n + 1})
+            except DuplicateKeyError:
+                await releaseParts(mongo, bots, retained)
+                return False
+        retained += [p for p in parts if p["tg_message"] == m]
+    return True
@@ -0,0 +1,83 @@
+from asyncio import sleep
+from collections import OrderedDict
+from time import monotonic
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId
+from metrics import telegram_duration, flood_waits, flood_wait_seconds
+
+FILE_ID_CACHE_SIZE = 10000
+
+class BotPool:
+    def __init__(self, tokens, api_id, api_hash, chat_id):
+        self.chat_id = chat_id
+        self.clients = [
+            Client(f"S3_Bot_{i}", api_id=api_id, api_hash=api_hash, bot_token=token, in_memory=True)
+            for i, token in enumerate(tokens)
+        ]
+        self.ids = {}
+        self.load = {client: 0 for client in self.clients}
+        self.flood_until = {client: 0 for client in self.clients}
+        self.file_ids = OrderedDict()
+
+    async def start(self):
+        for client in self.clients:
+            await client.start()
+            self.ids[client] = (await client.get_me()).id
+
+    async def stop(self):
+        for client in self.clients:
+            await client.stop()
+
+    def throttle(self, client, seconds):
+        flood_waits.inc(client.name)
+        flood_wait_seconds.inc(client.name, value=seconds)
+        self.flood_until[client] = max(self.flood_until[client], monotonic() + seconds)
+
+    def pick(self, prefer=None):
+        now = monotonic()
+        available = [c for c in self.clients if self.flood_until[c] <= now]
+        if not available:
+            return min(self.clients, key=self.flood_until.get)
+        for client in available:
+            if self.ids.get(client) == prefer:
+                return client
+        return min(available, key=self.load.get)
+
+    async def run(self, fn, prefer=None):
+        while True:
+            client = self.pick(prefer)
+            if (wait := self.flood_until[client] - monotonic()) > 0:
+                await sleep(wait)
+            self.load[client] += 1
+            try:
+                return await fn(client)
+            except FloodWait as e:
+                self.throttle(client, e.value)
+            finally:
+                self.load[client] -= 1
+
+    async def send(self, client, query):
+        while True:
+            try:
+                with telegram_duration.time(type(query).__name__, await client.storage.dc_id()):
+                    return await client.invoke(query)
+            except FloodWait as e:
+                self.throttle(client, e.value)
+                await sleep(e.value)
+
+    async def file_id(self, client, part):
+        if self.ids[client] == part.get("bot", self.ids[self.clients[0]]):
+            return FileId.decode(part["tg_file"])
+        key = (self.ids[client], part["tg_message"])
+        if (file_id := self.file_ids.get(key)):
+            self.file_ids.move_to_end(key)
+            return file_id
+        message = await client.get_messages(self.chat_id, part["tg_message"])
+        file_id = self.file_ids[key] = FileId.decode(message.document.file_id)
+        if len(self.file_ids) > FILE_ID_CACHE_SIZE:
+            self.file_ids.popitem(last=False)
+        return file_id
+
+    async def delete_messages(self, message_ids):
+        await self.run(lambda client: client.delete_messages(self.chat_id, message_ids))
@@ -0,0 +1,98 @@
+from asyncio import create_task, shield, to_thread
+from collections import OrderedDict
+from os import environ, makedirs, remove, replace, scandir
+from os.path import join
+
+class ChunkCache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+        makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        files = [f for f in scandir(self.path) if f.is_file() and not f.name.endswith(".tmp")]
+        files.sort(key=lambda f: f.stat().st_atime)
+        for f in files:
+            media_id, _, offset = f.name.partition("_")
+            try:
+                key = (int(media_id), int(offset))
+            except ValueError:
+                continue
+            self.entries[key] = f.stat().st_size
+            self.size += self.entries[key]
+        self._evict()
+
+    def _file(self, key):
+        return join(self.path, f"{key[0]}_{key[1]}")
+
+    def _read(self, key):
+        with open(self._file(key), "rb") as f:
+            return f.read()
+
+    def _write(self, key, data):
+        tmp = self._file(key) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        replace(tmp, self._file(key))
+
+    def _drop(self, key):
+        if (size := self.entries.pop(key, None)) is None:
+            return
+        self.size -= size
+        try:
+            remove(self._file(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            self._drop(next(iter(self.entries)))
+
+    async def put(self, key, data):
+        if len(data) > self.max_size:
+            return
+        try:
+            await to_thread(self._write, key, data)
+        except OSError:
+            return
+        self.size -= self.entries.pop(key, 0)
+        self.entries[key] = len(data)
+        self.size += len(data)
+        self._evict()
+
+    def rename(self, key, new_key):
+        if (size := self.entries.pop(key, None)) is None:
+            return
+        try:
+            replace(self._file(key), self._file(new_key))
+        except OSError:
+            self.size -= size
+            return
+        self.size -= self.entries.pop(new_key, 0)
+        self.entries[new_key] = size
+
+    async def _fetch(self, key, fetch):
+        try:
+            data = await fetch()
+            await self.put(key, data)
+            return data
+        finally:
+            del self.pending[key]
+
+    async def get(self, key, fetch):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            try:
+                return await to_thread(self._read, key)
+            except OSError:
+                self._drop(key)
+        if not (task := self.pending.get(key)):
+            task = self.pending[key] = create_task(self._fetch(key, fetch))
+        return await shield(task)
+
+chunk_cache = ChunkCache(environ["CACHE_DIR"], int(environ.get("CACHE_SIZE", 1024 * 1024 * 1024))) if environ.get("CACHE_DIR") else None
+cache_uploads = chunk_cache is not None and environ.get("CACHE_UPLOADS", "").lower() in ("1", "true", "yes")
@@ -1,51 +1,137 @@
-from quart import Quart, request
-from pyrogram import Client
+from os.path import exists
+if exists(".env"):
+    from dotenv import load_dotenv
+    load_dotenv()
+from quart import Quart, request, g
+from bots import BotPool
 from s3 import *
 from motor.motor_asyncio import AsyncIOMotorClient
-from asyncio import get_event_loop
-from auth import SignatureV4
+from pymongo.errors import DuplicateKeyError
+from asyncio import CancelledError, gather, get_event_loop, sleep, to_thread
+from auth import SignatureV4, PayloadMismatch, ChunkSignatureMismatch, UnsupportedPayload, sha256_pattern
 from os import environ
-from os.path import exists
 from functools import wraps
 from datetime import datetime
-from time import time
-from re import compile
-from utils import patch_binaryio
-from tg import stream_file
-from base64 import b64decode
+from time import time, perf_counter
+from re import compile, escape
+from utils import parse_range, check_preconditions, update_digests, localName, TTLCache
+from xml.etree import ElementTree
+from tg import stream_file, upload_stream, locate_parts, UploadSizeMismatch, OBJECT_PART_SIZE, SNIFF_SIZE
+from blobs import releaseParts, claimUploadParts, retainParts as retainBlobs
+from reclaimer import Reclaimer
+from packer import Packer, PACK_THRESHOLD
+from spool import Spool
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
+from urllib.parse import quote as urlquote, unquote as urlunquote
 from uuid import uuid4
-from hashlib import md5
-from io import BytesIO
+from hashlib import md5, sha256
+from email.utils import formatdate
 from magic import from_buffer
-if exists(".env"):
-    from dotenv import load_dotenv
-    load_dotenv()
+import metrics
 import sys
 
 bucket_name_pattern = compile('^[a-z0-9_-]{1,255}$')
-etag_pattern = compile(r'(?:<ETag>")([a-z\d]{32})(?:"<\/ETag>)')
-partnum_pattern = compile(r'(?:<PartNumber>)(\d{1,})(?:<\/PartNumber>)')
 access_pattern = compile(r'(?:<BlockPublicAcls>)(true|false)(?:<\/BlockPublicAcls>)')
 
+LAST_CHAR = "\U0010ffff"
+PREFIX_SCAN = 100
+ROLLUP_SCAN = 1000
+DEDUP = environ.get("DEDUP", "").lower() in ("1", "true", "yes")
+OBJECT_META = {"name": 1, "size": 1, "hash": 1, "time": 1, "mime_type": 1, "cache_control": 1}
+
+users_cache = TTLCache(int(environ.get("USER_CACHE_TTL", 10)))
+buckets_cache = TTLCache(int(environ.get("BUCKET_CACHE_TTL", 60)))
+
+reclaimer = None
+packer = None
+spool = None
+
 app = Quart("Telegram_S3")
 app.url_map.strict_slashes = False
-app.config['MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024 * 1024
 app.config["RESPONSE_TIMEOUT"] = 9000
 app.config["BODY_TIMEOUT"] = 600
 
+def mediaSessions():
+    return {(client.name, dc_id): len(pool.sessions) for client in bots.clients for dc_id, pool in client.media_sessions.items()}
+
+def reclaimerStats():
+    return {(name,): value for name, value in reclaimer.stats.items()} if reclaimer else {}
+
+metrics.Gauge("telegram_media_sessions", "Open media sessions, by bot and DC.", ("bot", "dc"), callback=mediaSessions)
+metrics.Counter("s3_reclaimer_total", "Work done by the background reclaimer.", ("stat",), callback=reclaimerStats)
+metrics.Gauge("s3_spool_pending_objects", "Spooled uploads waiting to be sent to telegram.", callback=lambda: {(): len(spool.sizes)} if spool else {})
+metrics.Gauge("s3_spool_pending_bytes", "Bytes of spooled uploads waiting to be sent to telegram.", callback=lambda: {(): spool.size} if spool else {})
+
 @app.before_serving
 async def startup():
-    global bot, mongo
-    bot = Client(
-        "S3_Bot",
-        api_id=int(environ.get("API_ID", 0)),
-        api_hash=environ.get("API_HASH"),
-        bot_token=environ.get("BOT_TOKEN"),
-        in_memory=True
-    )
-    await bot.start()
+    global bots, mongo, reclaimer, packer, spool
+    tokens = [t.strip() for t in environ.get("BOT_TOKENS", environ.get("BOT_TOKEN", "")).split(",") if t.strip()]
+    bots = BotPool(tokens, int(environ.get("API_ID", 0)), environ.get("API_HASH"), int(environ.get("CHAT_ID")))
+    await bots.start()
     loop = get_event_loop()
     mongo = AsyncIOMotorClient(environ.get("MONGODB"), io_loop=loop).s3
+    if environ.get("BUCKET_CACHE_WATCH", "").lower() in ("1", "true", "yes"):
+        loop.create_task(watchCache(mongo.buckets, buckets_cache))
+    if environ.get("USER_CACHE_WATCH", "").lower() in ("1", "true", "yes"):
+        loop.create_task(watchCache(mongo.users, users_cache))
+    if PACK_THRESHOLD > 0:
+        packer = Packer(bots, mongo)
+    if (spool_dir := environ.get("SPOOL_DIR")):
+        spool = Spool(spool_dir, bots, mongo, registerBlob, packer)
+        await spool.recover()
+        spool.start()
+    if (interval := int(environ.get("GC_INTERVAL", 0))) > 0:
+        reclaimer = Reclaimer(mongo, bots, int(environ.get("UPLOAD_EXPIRY", 7 * 86400)), batch_delay=float(environ.get("GC_BATCH_DELAY", 1)), packer=packer)
+        loop.create_task(reclaimer.runForever(interval))
+
+@app.before_request
+async def startTimer():
+    g.start = perf_counter()
+
+@app.after_request
+async def recordRequest(response):
+    metrics.request_duration.observe(request.endpoint or "unmatched", request.method, response.status_code, value=perf_counter() - g.start)
+    if request.method in ("PUT", "POST") and request.content_length:
+        metrics.bytes_received.inc(value=request.content_length)
+    return response
+
+async def sendBody(chunks):
+    try:
+        async for chunk in chunks:
+            metrics.bytes_sent.inc(value=len(chunk))
+            yield chunk
+    except (GeneratorExit, CancelledError):
+        metrics.stream_aborts.inc("client")
+        raise
+
+async def getBucket(name):
+    if (b := buckets_cache.get(name)):
+        return b
+    if (b := await mongo.buckets.find_one({"name": name}, {"_id": 0, "name": 1, "owner": 1, "public": 1, "time": 1, "cache_control": 1})):
+        buckets_cache.set(name, b)
+    return b
+
+async def watchCache(collection, cache):
+    while True:
+        try:
+            async with collection.watch() as stream:
+                cache.invalidate()
+                async for _ in stream:
+                    cache.invalidate()
+        except Exception as e:
+            print(f"Change stream on {collection.name} failed: {e}", file=sys.stderr)
+            await sleep(5)
+
+async def getUser(id, cached=True):
+    if not id:
+        return None
+    if cached and (u := users_cache.get(id)):
+        return u
+    users_cache.invalidate(id)
+    if (u := await mongo.users.find_one({"id": id})):
+        users_cache.set(id, u)
+    return u
 
 def auth(allow_public=False):
     def _auth(f):
@@ -54,11 +140,14 @@ def auth(allow_public=False):
             a = SignatureV4(request)
             if not a.userId and not allow_public:
                 return InvalidAccessKeyId
-            if not (u := await mongo.users.find_one({"id": a.userId})) and not allow_public:
+            if not (u := await getUser(a.userId)) and not allow_public:
                 return InvalidAccessKeyId
-            if u and not a.verify(u["key"]) and not allow_public:
-                return SignatureDoesNotMatch
+            if u and not a.verify(u["key"]):
+                u = await getUser(a.userId, cached=False)
+                if (not u or not a.verify(u["key"])) and not allow_public:
+                    return SignatureDoesNotMatch
             if a.verified:
+                g.signature = a
                 kwargs["user"] = User(a.userId, u.get("name"))
             return await f(*args, **kwargs)
         return wrapped
@@ -87,125 +176,488 @@ async def listBuckets(user):
 @auth()
 @_lower(["bucket"])
 async def deleteBucket(bucket, user):
-    if not await mongo.buckets.find_one({"name": bucket, "owner": user.id}):
+    if not (b := await getBucket(bucket)) or b["owner"] != user.id:
         return NoSuchBucket
+    if await mongo.objects.find_one({"bucket": bucket}, {"_id": 1}):
+        return BucketNotEmpty
     await mongo.buckets.delete_one({"name": bucket, "owner": user.id})
+    buckets_cache.invalidate(bucket)
     return "", 204
 
+async def listObjects(bucket, owner, prefix, delimiter, start, max_keys, state):
+    count = 0
+    state["truncated"] = False
+    while not state["truncated"]:
+        name = {"$gt": start} if start else {}
+        if prefix:
+            name["$regex"] = f"^{escape(prefix)}"
+        query = {"owner": owner, "bucket": bucket, "incomplete": {"$exists": False}}
+        if name:
+            query["name"] = name
+        limit = max_keys - count + 1 + ROLLUP_SCAN
+        cursor = mongo.objects.find(query, {"name": 1, "hash": 1, "size": 1, "time": 1}).sort("name", 1).limit(limit)
+        current = None
+        read = rolled = 0
+        seek = False
+        async for obj in cursor:
+            read += 1
+            if current and obj["name"].startswith(current):
+                # Small common prefixes are cheaper to read through than to re-seek past.
+                rolled += 1
+                if rolled > PREFIX_SCAN:
+                    seek = True
+                    break
+                continue
+            if count == max_keys:
+                state["truncated"] = True
+                break
+            count += 1
+            if delimiter and (i := obj["name"].find(delimiter, len(prefix))) != -1:
+                current = state["last"] = obj["name"][:i + len(delimiter)]
+                start = state["start"] = current + LAST_CHAR
+                rolled = 0
+                yield current
+                continue
+            current = None
+            state["last"] = start = state["start"] = obj["name"]
+            yield obj
+        else:
+            seek = read == limit
+        if not seek:
+            break
+
 @app.route("/<string:bucket>", methods=["GET"])
 @auth()
 @_lower(["bucket"])
 async def bucketData(bucket, user):
-    if not await mongo.buckets.find_one({"name": bucket, "owner": user.id}):
+    if not (b := await getBucket(bucket)) or b["owner"] != user.id:
         return NoSuchBucket
     if "location" in request.args:
         return LocationConstraint().gen()
     elif "versioning" in request.args:
         return VersioningConfiguration().gen()
-    objects = []
+    elif "cacheControl" in request.args:
+        return "", 200, {"Cache-Control": b["cache_control"]} if b.get("cache_control") else {}
+    v2 = request.args.get("list-type") == "2"
+    prefix = request.args.get("prefix", "")
+    delimiter = request.args.get("delimiter", "")
+    etype = "url" if request.args.get("encoding-type") == "url" else None
+    try:
+        max_keys = min(max(int(request.args.get("max-keys", 1000)), 0), 1000)
+        if v2 and (token := request.args.get("continuation-token")):
+            start = urlsafe_b64decode(token.encode("utf8")).decode("utf8")
+        else:
+            start = request.args.get("start-after" if v2 else "marker", "")
+            if delimiter and start.startswith(prefix) and start.endswith(delimiter) and start.find(delimiter, len(prefix)) == len(start) - len(delimiter):
+                start += LAST_CHAR
+    except ValueError:
+        return InvalidArgument
     ow = Owner(user.id, user.name)
-    async for obj in mongo.objects.find({"owner": user.id, "bucket": bucket, "incomplete": {"$exists": False}}).limit(1000):
-        objects.append(Contents(obj["name"], obj["hash"], ow, obj["size"], obj["modified"]))
-    return ListBucketResult(objects, bucket)
+    quote = (lambda v: urlquote(v, safe="/")) if etype else (lambda v: v)
+    result = ListBucketResult(None, bucket, etype, False, max_keys, quote(prefix), delimiter=quote(delimiter) or None, v2=v2)
+    if v2:
+        result.continuation_token = request.args.get("continuation-token")
+        result.start_after = request.args.get("start-after")
+    else:
+        result.marker = quote(request.args.get("marker", ""))
+
+    async def entries():
+        state = {}
+        async for entry in listObjects(bucket, user.id, prefix, delimiter, start, max_keys, state):
+            if isinstance(entry, str):
+                yield CommonPrefixes(quote(entry))
+            else:
+                yield Contents(quote(entry["name"]), f"\"{entry['hash']}\"", ow, entry["size"], datetime.utcfromtimestamp(entry["time"]).strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+        result.is_trunc = state["truncated"]
+        if state["truncated"] and v2:
+            result.next_continuation_token = urlsafe_b64encode(state["start"].encode("utf8")).decode("utf8")
+        elif state["truncated"] and delimiter:
+            result.next_marker = quote(state["last"])
+
+    result.items = entries()
+    return result.stream(), 200, {"Content-Type": "application/xml"}
+
+@app.route("/<string:bucket>", methods=["POST"])
+@auth()
+@_lower(["bucket"])
+async def deleteObjects(bucket, user):
+    if "delete" not in request.args:
+        return InvalidArgument
+    if not (b := await getBucket(bucket)) or b["owner"] != user.id:
+        return NoSuchBucket
+    data, error = await checkedBody(readBody())
+    if error:
+        return error
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError:
+        return MalformedXML
+    quiet = False
+    keys = []
+    for el in root:
+        if localName(el.tag) == "Quiet":
+            quiet = (el.text or "").strip().lower() == "true"
+        elif localName(el.tag) == "Object":
+            keys += [k.text or "" for k in el if localName(k.tag) == "Key"]
+    if not keys or len(keys) > 1000:
+        return MalformedXML
+    # Each key is removed atomically so a concurrent PUT that replaced it keeps its parts.
+    deleted = await gather(*[mongo.objects.find_one_and_delete({"bucket": bucket, "owner": user.id, "name": key, "incomplete": {"$exists": False}}, {"parts": 1}) for key in set(keys)])
+    await deleteParts([p for r in deleted if r for p in r["parts"]])
+    return DeleteResult([] if quiet else [Deleted(k) for k in keys]).gen(), 200, {"Content-Type": "application/xml"}
 
 @app.route("/<string:bucket>", methods=["PUT"])
 @auth()
 @_lower(["bucket"])
 async def putBucket(bucket, user):
-    b = await mongo.buckets.find_one({"name": bucket})
+    b = await getBucket(bucket)
     if "publicAccessBlock" in request.args:
         if not b or b["owner"] != user.id:
             return NoSuchBucket
-        acc = access_pattern.findall((await request.body).decode("utf8"))
+        data, error = await checkedBody(readBody())
+        if error:
+            return error
+        acc = access_pattern.findall(data.decode("utf8"))
         if acc:
             public = acc[0].lower() == "false"
             await mongo.buckets.update_one({"name": bucket, "owner": user.id}, {"$set": {"public": public}})
+            buckets_cache.invalidate(bucket)
+    elif "cacheControl" in request.args:
+        if not b or b["owner"] != user.id:
+            return NoSuchBucket
+        await mongo.buckets.update_one({"name": bucket, "owner": user.id}, {"$set": {"cache_control": request.headers.get("Cache-Control") or None}})
+        buckets_cache.invalidate(bucket)
     else:
         if not bucket_name_pattern.match(bucket):
             return InvalidBucketName
         if b:
             return BucketAlreadyExists
         await mongo.buckets.insert_one({"name": bucket, "owner": user.id, "time": round(time()), "public": True})
+        buckets_cache.invalidate(bucket)
     return ""
 
 @app.route("/<string:bucket>/<path:file>", methods=["DELETE"])
 @auth()
 @_lower(["bucket"])
 async def deleteObject(bucket, file, user):
-    if not (r := await mongo.objects.find_one({"bucket": bucket, "name": file, "owner": user.id})):
-        return "", 204
-    await mongo.buckets.delete_one({"bucket": bucket, "name": file, "owner": user.id})
-    messages = [p["tg_message"] for p in r["parts"]]
-    await bot.delete_messages(int(environ.get("CHAT_ID")), messages)
+    if (uploadId := request.args.get("uploadId")):
+        return await abortMultipartUpload(bucket, file, user, uploadId)
+    if (r := await mongo.objects.find_one_and_delete({"bucket": bucket, "name": file, "owner": user.id, "incomplete": {"$exists": False}}, {"parts": 1})):
+        await deleteParts(r["parts"])
     return "", 204
 
+async def deleteParts(parts):
+    await releaseParts(mongo, bots, parts)
+
+async def retainParts(parts):
+    return await retainBlobs(mongo, bots, parts)
+
+async def storeObject(obj):
+    while True:
+        try:
+            old = await mongo.objects.find_one_and_replace({"bucket": obj["bucket"], "name": obj["name"], "hash": {"$type": "string"}}, obj, {"parts": 1}, upsert=True)
+            break
+        except DuplicateKeyError:
+            # A concurrent upsert created the key first; replace it instead.
+            continue
+    if old:
+        await deleteParts(old["parts"])
+
+def blobPart(blob):
+    return {"tg_file": blob["tg_file"], "tg_message": blob["_id"], "bot": blob["bot"], "size": blob["size"], "hash": blob["hash"]}
+
+async def registerBlob(document, owner):
+    document = dict(document)
+    digest = document.pop("sha256")
+    if DEDUP and (blob := await mongo.blobs.find_one_and_update({"owner": owner, "sha256": digest, "size": document["size"], "refs": {"$gt": 0}, "pack": {"$exists": False}}, {"$inc": {"refs": 1}})):
+        await bots.delete_messages([document["tg_message"]])
+        return blobPart(blob)
+    await mongo.blobs.insert_one({"_id": document["tg_message"], "refs": 1, "tg_file": document["tg_file"], "bot": document["bot"], "size": document["size"], "hash": document["hash"], "sha256": digest, "owner": owner})
+    return document
+
+def requestBody():
+    if (signature := g.get("signature")):
+        return signature.payload(request.body)
+    return request.body
+
+def payloadSize(request):
+    if request.headers.get("x-amz-content-sha256", "").startswith("STREAMING-"):
+        try:
+            return int(request.headers["x-amz-decoded-content-length"])
+        except (KeyError, ValueError):
+            return None
+    return request.content_length
+
+async def readBody():
+    return b"".join([chunk async for chunk in requestBody()]), None
+
+async def checkedBody(read):
+    try:
+        return await read
+    except UnsupportedPayload:
+        return None, UnsupportedContentSHA256
+    except ChunkSignatureMismatch:
+        return None, SignatureDoesNotMatch
+    except PayloadMismatch:
+        return None, XAmzContentSHA256Mismatch
+
+async def sniffMime(head):
+    return await to_thread(from_buffer, head, mime=True)
+
+async def reuseBlob(request, chunks, size, digest, owner):
+    if not (blob := await mongo.blobs.find_one_and_update({"owner": owner, "sha256": digest, "size": size, "refs": {"$gt": 0}, "pack": {"$exists": False}}, {"$inc": {"refs": 1}})):
+        return None, None
+    checksum = md5()
+    content_sha256 = sha256()
+    head = b""
+    received = 0
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            await update_digests(chunk, checksum, content_sha256)
+            if len(head) < SNIFF_SIZE:
+                head += chunk[:SNIFF_SIZE - len(head)]
+    except BaseException:
+        await deleteParts([blobPart(blob)])
+        raise
+    if received != size:
+        error = IncompleteBody
+    elif content_sha256.hexdigest() != digest:
+        error = XAmzContentSHA256Mismatch
+    elif (content_md5 := request.content_md5) and b64decode(bytes(content_md5, "utf8")).hex() != checksum.hexdigest():
+        error = BadDigest
+    else:
+        error = None
+    if error:
+        await deleteParts([blobPart(blob)])
+        return None, error
+    return {
+        "documents": [blobPart(blob)],
+        "size": size,
+        "hash": checksum.hexdigest(),
+        "mime_type": await sniffMime(head)
+    }, None
+
+async def packBody(request, chunks, size):
+    data = bytearray()
+    async for chunk in chunks:
+        data += chunk
+        if len(data) > size:
+            return None, IncompleteBody
+    if len(data) != size:
+        return None, IncompleteBody
+    checksum = md5()
+    await update_digests(data, checksum)
+    md5_checksum = checksum.hexdigest()
+    if (content_md5 := request.content_md5) and b64decode(bytes(content_md5, "utf8")).hex() != md5_checksum:
+        return None, BadDigest
+    return {
+        "documents": [await packer.add(bytes(data))],
+        "size": size,
+        "hash": md5_checksum,
+        "mime_type": await sniffMime(bytes(data[:SNIFF_SIZE]))
+    }, None
+
+async def uploadBody(request, user):
+    if (size := payloadSize(request)) is None:
+        return None, MissingContentLength
+    chunks = requestBody()
+    if DEDUP and sha256_pattern.match(digest := request.headers.get("x-amz-content-sha256", "")) and 0 < size <= OBJECT_PART_SIZE:
+        body, error = await reuseBlob(request, chunks, size, digest, user.id)
+        if body or error:
+            return body, error
+    if packer and 0 < size <= PACK_THRESHOLD:
+        return await packBody(request, chunks, size)
+    try:
+        documents, md5_checksum, head = await upload_stream(bots, chunks, size)
+    except UploadSizeMismatch:
+        return None, IncompleteBody
+    if (content_md5 := request.content_md5) and b64decode(bytes(content_md5, "utf8")).hex() != md5_checksum:
+        await bots.delete_messages([d["tg_message"] for d in documents])
+        return None, BadDigest
+    return {
+        "documents": [await registerBlob(d, user.id) for d in documents],
+        "size": size,
+        "hash": md5_checksum,
+        "mime_type": await sniffMime(head)
+    }, None
+
+async def spoolBody(request):
+    size = payloadSize(request)
+    try:
+        spool_id, md5_checksum, head = await spool.write(requestBody(), size)
+    except UploadSizeMismatch:
+        return None, IncompleteBody
+    if (content_md5 := request.content_md5) and b64decode(bytes(content_md5, "utf8")).hex() != md5_checksum:
+        spool.discard(spool_id)
+        return None, BadDigest
+    return {
+        "documents": [],
+        "spool": spool_id,
+        "size": size,
+        "hash": md5_checksum,
+        "mime_type": await sniffMime(head)
+    }, None
+
+async def objectBody(obj, start=0, end=None):
+    if obj.get("spool"):
+        if spool and (f := await spool.open(obj["spool"])):
+            return spool.stream(f, start, end)
+        if not (obj := await mongo.objects.find_one({"_id": obj["_id"]}, {"parts": 1, "spool": 1})) or obj.get("spool"):
+            return None
+    return stream_file(obj["parts"], bots, start, end)
+
 async def putObjectSinglepart(request, bucket, file, user):
-    b = await request.body
-    data = BytesIO(b)
-    h = True
-    if not (md5_checksum := request.content_md5):
-        m, h = patch_binaryio(data), False
-    msg = await bot.send_document(int(environ.get("CHAT_ID")), data, file_name="file", force_document=True)
-    if not h:
-        md5_checksum = m.hexdigest()
+    if spool and spool.accepts(payloadSize(request)):
+        body, error = await checkedBody(spoolBody(request))
     else:
-        md5_checksum = b64decode(bytes(md5_checksum, "utf8")).hex()
-    if await mongo.objects.find_one({"name": file, "bucket": bucket}):
-        await mongo.objects.delete_one({"name": file, "bucket": bucket})
-    await mongo.objects.insert_one({
+        body, error = await checkedBody(uploadBody(request, user))
+    if error:
+        return error
+    parts = []
+    offset = 0
+    for i, document in enumerate(body["documents"]):
+        parts.append({"part_id": i, **document, "offset": offset})
+        offset += document["size"]
+    obj = {
         "name": file,
         "owner": user.id,
         "time": round(time()),
-        "size": len(b),
-        "mime_type": from_buffer(b, mime=True),
+        "size": body["size"],
+        "mime_type": body["mime_type"],
         "bucket": bucket,
-        "hash": md5_checksum,
-        "parts": [{
-            "part_id": 0,
-            "tg_file": msg.document.file_id,
-            "tg_message": msg.id
-        }]
-    })
-    return "", 200, {"etag": f"\"{md5_checksum}\""}
+        "hash": body["hash"],
+        "cache_control": request.headers.get("Cache-Control"),
+        "parts": parts
+    }
+    if body.get("spool"):
+        obj["spool"] = body["spool"]
+    await storeObject(obj)
+    if body.get("spool"):
+        spool.enqueue(body["spool"])
+    return "", 200, {"etag": f"\"{body['hash']}\""}
 
 async def putObjectMultipart(request, bucket, file, user, uploadId, partNumber):
-    b = await request.body
-    data = BytesIO(b)
-    h = True
-    if not (md5_checksum := request.content_md5):
-        m, h = patch_binaryio(data), False
-    msg = await bot.send_document(int(environ.get("CHAT_ID")), data, file_name="file", force_document=True)
-    if not h:
-        md5_checksum = m.hexdigest()
+    body, error = await checkedBody(uploadBody(request, user))
+    if error:
+        return error
+    await storePart(uploadId, partNumber, body["documents"], body["size"], body["hash"], body["mime_type"])
+    return "", 200, {"etag": f"\"{body['hash']}\""}
+
+async def storePart(uploadId, partNumber, documents, size, etag, mime_type):
+    old = await mongo.upload_parts.find_one_and_replace({"uploadId": uploadId, "part_id": partNumber}, {
+        "uploadId": uploadId,
+        "part_id": partNumber,
+        "time": round(time()),
+        "size": size,
+        "etag": etag,
+        "mime_type": mime_type,
+        "documents": documents
+    }, upsert=True)
+    if old:
+        await deleteParts(old["documents"])
+
+async def getUpload(uploadId, bucket, file, user):
+    return await mongo.objects.find_one({"uploadId": uploadId, "bucket": bucket, "name": file, "owner": user.id, "incomplete": True}, {"parts": 0})
+
+async def getCopySource(user):
+    source = urlunquote(request.headers["x-amz-copy-source"].split("?", 1)[0]).lstrip("/")
+    src_bucket, _, src_file = source.partition("/")
+    src_bucket = src_bucket.lower()
+    if not (b := await getBucket(src_bucket)) or (not b["public"] and b["owner"] != user.id):
+        return None, NoSuchBucket
+    if not (r := await mongo.objects.find_one({"bucket": src_bucket, "name": src_file, "incomplete": {"$exists": False}})):
+        return None, NoSuchKey
+    return r, None
+
+async def copyObject(bucket, file, user):
+    src, error = await getCopySource(user)
+    if error:
+        return error
+    spool_id = None
+    if src.get("spool") and (not spool or not (spool_id := await spool.link(src["spool"]))):
+        return InternalError
+    if not await retainParts(src["parts"]):
+        return NoSuchKey
+    modified = round(time())
+    replace = request.headers.get("x-amz-metadata-directive", "COPY").upper() == "REPLACE"
+    obj = {
+        "name": file,
+        "owner": user.id,
+        "time": modified,
+        "size": src["size"],
+        "mime_type": src["mime_type"],
+        "bucket": bucket,
+        "hash": src["hash"],
+        "cache_control": request.headers.get("Cache-Control") if replace else src.get("cache_control"),
+        "parts": src["parts"]
+    }
+    if spool_id:
+        obj["spool"] = spool_id
+    await storeObject(obj)
+    if spool_id:
+        spool.enqueue(spool_id)
+    return CopyObjectResult(src["hash"], datetime.utcfromtimestamp(modified).strftime("%Y-%m-%dT%H:%M:%S.000Z")).gen(), 200, {"Content-Type": "application/xml"}
+
+async def uploadPartCopy(bucket, file, user, uploadId, partNumber):
+    src, error = await getCopySource(user)
+    if error:
+        return error
+    if not all("size" in p for p in src["parts"]):
+        return CopySourceNotSeekable
+    start, end = 0, src["size"]
+    if (header := request.headers.get("x-amz-copy-source-range")):
+        if not (rng := parse_range(header, src["size"])):
+            return InvalidRange
+        start, end = rng
+    pieces = locate_parts(src["parts"], start, end)
+    if not src.get("spool") and all(s == 0 and e == p["size"] for p, s, e in pieces):
+        documents = [{k: p[k] for k in ("tg_file", "tg_message", "bot", "size", "hash", "base") if k in p} for p, _, _ in pieces]
+        if not await retainParts(documents):
+            return NoSuchKey
+        if len(documents) == 1 and documents[0].get("hash"):
+            etag = documents[0]["hash"]
+        elif start == 0 and end == src["size"] and len(src["hash"]) == 32:
+            etag = src["hash"]
+        else:
+            etag = md5("".join([d.get("hash") or str(d["tg_message"]) for d in documents]).encode("utf8")).hexdigest()
     else:
-        md5_checksum = b64decode(bytes(md5_checksum, "utf8")).hex()
-    payload = {"$inc": {"size": len(b)}, "$push": {"parts": {"part_id": partNumber, "tg_file": msg.document.file_id, "tg_message": msg.id}}}
-    if partNumber == 1:
-        m = from_buffer(b, mime=True)
-        payload["$set"] = {"mime_type": m}
-    await mongo.objects.update_one({"uploadId": uploadId}, payload)
-    return "", 200, {"etag": f"\"{md5_checksum}\""}
+        if (source := await objectBody(src, start, end)) is None:
+            return InternalError
+        try:
+            documents, etag, _ = await upload_stream(bots, source, end - start)
+        except UploadSizeMismatch:
+            return InternalError
+        documents = [await registerBlob(d, user.id) for d in documents]
+    await storePart(uploadId, partNumber, documents, end - start, etag, src["mime_type"])
+    return CopyPartResult(etag, datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z")).gen(), 200, {"Content-Type": "application/xml"}
 
 @app.route("/<string:bucket>/<path:file>", methods=["PUT"])
 @auth()
 @_lower(["bucket"])
 async def putObject(bucket, file, user):
-    b = await mongo.buckets.find_one({"name": bucket, "owner": user.id})
-    if not b:
+    if not (b := await getBucket(bucket)) or b["owner"] != user.id:
         return NoSuchBucket
+    copy = "x-amz-copy-source" in request.headers
     if (uploadId := request.args.get("uploadId")):
-        partNumber = request.args.get("partNumber", 0)
-        return await putObjectMultipart(request, bucket, file, user, uploadId, int(partNumber))
+        if not await getUpload(uploadId, bucket, file, user):
+            return NoSuchUpload
+        if not (partNumber := request.args.get("partNumber", "")).isdigit() or not 1 <= int(partNumber) <= 10000:
+            return InvalidArgument
+        partNumber = int(partNumber)
+        if copy:
+            return await uploadPartCopy(bucket, file, user, uploadId, partNumber)
+        return await putObjectMultipart(request, bucket, file, user, uploadId, partNumber)
+    elif copy:
+        return await copyObject(bucket, file, user)
     else:
         return await putObjectSinglepart(request, bucket, file, user)
-    return ""
 
 @app.route("/<string:bucket>/<path:file>", methods=["POST"])
 @auth()
 @_lower(["bucket"])
 async def createMultipartUpload(bucket, file, user):
     if "uploads" in request.args:
-        await mongo.buckets.delete_one({"bucket": bucket, "name": file, "owner": user.id})
         uploadId = str(uuid4())
         await mongo.objects.insert_one({
             "name": file,
@@ -215,25 +667,121 @@ async def createMultipartUpload(bucket, file, user):
             "mime_type": None,
             "bucket": bucket,
             "hash": None,
+            "cache_control": request.headers.get("Cache-Control"),
             "parts": [],
             "incomplete": True,
             "uploadId": uploadId
         })
         return InitiateMultipartUploadResult(bucket, file, uploadId).gen()
     elif (uploadId := request.args.get("uploadId")):
-        b = await request.body
-        b = b.decode("utf8")
-        parts = list(zip(etag_pattern.findall(b), partnum_pattern.findall(b)))
-        parts.sort(key=lambda x: int(x[1]))
-        parts = [m[0] for m in parts]
-        b = b""
-        for part in parts:
-            b += bytes.fromhex(part)
-        m = md5()
-        m.update(b)
-        hash = m.hexdigest()+f"-{len(parts)}"
-        await mongo.objects.update_one({"uploadId": uploadId}, {"$set": {"hash": hash}, "$unset": {"incomplete": 1, "uploadId": 1}})
-        return CompleteMultipartUploadResult(bucket, file, hash).gen()
+        return await completeMultipartUpload(bucket, file, user, uploadId)
+    return InvalidArgument
+
+def multipartETag(etags):
+    checksum = md5()
+    for etag in etags:
+        checksum.update(bytes.fromhex(etag))
+    return checksum.hexdigest()+f"-{len(etags)}"
+
+async def completeMultipartUpload(bucket, file, user, uploadId):
+    if not (upload := await getUpload(uploadId, bucket, file, user)):
+        return NoSuchUpload
+    data, error = await checkedBody(readBody())
+    if error:
+        return error
+    try:
+        root = ElementTree.fromstring(data)
+        requested = []
+        for el in root:
+            if localName(el.tag) != "Part":
+                continue
+            fields = {localName(f.tag): (f.text or "").strip() for f in el}
+            requested.append((int(fields["PartNumber"]), fields["ETag"].strip('"')))
+    except (ElementTree.ParseError, KeyError, ValueError):
+        return MalformedXML
+    if not requested:
+        return MalformedXML
+    if any(a[0] >= b[0] for a, b in zip(requested, requested[1:])):
+        return InvalidPartOrder
+    stored = {}
+    async for part in mongo.upload_parts.find({"uploadId": uploadId}):
+        stored[part["part_id"]] = part
+    for number, etag in requested:
+        if number not in stored or (stored[number]["etag"] and stored[number]["etag"] != etag):
+            return InvalidPart
+    parts = []
+    offset = 0
+    for number, _ in requested:
+        for i, document in enumerate(stored[number]["documents"]):
+            parts.append({"part_id": number, "index": i, **document, "offset": offset})
+            offset += document["size"]
+    hash = await to_thread(multipartETag, [etag for _, etag in requested])
+    used = [number for number, _ in requested]
+    await mongo.upload_parts.update_many({"uploadId": uploadId, "part_id": {"$in": used}}, {"$set": {"used": True}})
+    replaced = None
+    while True:
+        try:
+            result = await mongo.objects.update_one({"_id": upload["_id"], "incomplete": True}, {
+                "$set": {"hash": hash, "parts": parts, "size": offset, "mime_type": stored[requested[0][0]].get("mime_type")},
+                "$unset": {"incomplete": 1, "uploadId": 1}
+            })
+            break
+        except DuplicateKeyError:
+            # The key is taken by a complete object; keep it aside until the upload is promoted.
+            if (old := await mongo.objects.find_one_and_delete({"bucket": bucket, "name": file, "hash": {"$type": "string"}})):
+                if replaced:
+                    await deleteParts(replaced["parts"])
+                replaced = old
+    if not result.matched_count:
+        # Aborted or expired while completing: put the previous object back and drop whatever is left of the upload.
+        if replaced:
+            try:
+                await mongo.objects.insert_one(replaced)
+            except DuplicateKeyError:
+                await deleteParts(replaced["parts"])
+        await mongo.upload_parts.update_many({"uploadId": uploadId}, {"$unset": {"used": 1}})
+        await deleteParts(await claimUploadParts(mongo, {"uploadId": uploadId}))
+        return NoSuchUpload
+    if replaced:
+        await deleteParts(replaced["parts"])
+    await deleteParts(await claimUploadParts(mongo, {"uploadId": uploadId, "used": {"$exists": False}}))
+    await mongo.upload_parts.delete_many({"uploadId": uploadId})
+    return CompleteMultipartUploadResult(bucket, file, hash).gen()
+
+async def abortMultipartUpload(bucket, file, user, uploadId):
+    if not (upload := await getUpload(uploadId, bucket, file, user)):
+        return NoSuchUpload
+    await mongo.objects.delete_one({"_id": upload["_id"]})
+    await deleteParts(await claimUploadParts(mongo, {"uploadId": uploadId}))
+    return "", 204
+
+async def listParts(bucket, file, user, uploadId):
+    if not await getUpload(uploadId, bucket, file, user):
+        return NoSuchUpload
+    try:
+        max_parts = min(max(int(request.args.get("max-parts", 1000)), 0), 1000)
+        marker = int(request.args.get("part-number-marker", 0))
+    except ValueError:
+        return InvalidArgument
+    parts = []
+    truncated = False
+    async for part in mongo.upload_parts.find({"uploadId": uploadId, "part_id": {"$gt": marker}}, {"documents": 0}).sort("part_id", 1).limit(max_parts + 1):
+        if len(parts) == max_parts:
+            truncated = True
+            break
+        parts.append(Part(part["part_id"], datetime.utcfromtimestamp(part["time"]).strftime("%Y-%m-%dT%H:%M:%S.000Z"), part["etag"] or "", part["size"]))
+    result = ListPartsResult(bucket, file, uploadId, parts, marker, max_parts, truncated, Owner(user.id, user.name))
+    return result.gen(), 200, {"Content-Type": "application/xml"}
+
+def objectHeaders(obj, bucket):
+    mime = obj["mime_type"] or "application/octet-stream"
+    headers = {"Content-Type": mime, "ETag": f"\"{obj['hash']}\"", "Last-Modified": formatdate(obj["time"], usegmt=True)}
+    if (cache_control := obj.get("cache_control") or bucket.get("cache_control")):
+        headers["Cache-Control"] = cache_control
+    if not (mime.startswith("image/") or mime.startswith("text/")):
+        name = obj["name"].split("/")[-1]
+        headers["Content-Disposition"] = f"attachment; filename={name}"
+    return headers
 
 @app.route("/<string:bucket>/<path:file>", methods=["GET", "HEAD"])
 @auth(True)
@@ -241,25 +789,49 @@ async def createMultipartUpload(bucket, file, user):
 async def getObject(bucket, file, user=None):
     if not user:
         user = User(None, None)
-    if not (b := await mongo.buckets.find_one({"name": bucket})):
+    if not (b := await getBucket(bucket)):
         return NoSuchBucket
+    if (uploadId := request.args.get("uploadId")) and request.method == "GET":
+        return await listParts(bucket, file, user, uploadId)
     if not b["public"] and b["owner"] != user.id:
         return Error("Forbidden", f"You dont have access to bucket \"{bucket}\"").gen(), 403
-    if not (r := await mongo.objects.find_one({"bucket": bucket, "name": file, "incomplete": {"$exists": False}})):
+    head = request.method == "HEAD"
+    if not (r := await mongo.objects.find_one({"bucket": bucket, "name": file, "incomplete": {"$exists": False}}, OBJECT_META if head else None)):
         return "", 404
-    if request.method == "HEAD":
-        return "", 200, {"Content-Length": r["size"]}
-    mime = r["mime_type"]
-    headers = {"Content-Type": mime or "application/octet-stream"}
-    if not (mime.startswith("image/") or mime.startswith("text/")):
-        name = r["name"].split("/")[-1]
-        headers["Content-Disposition"] = f"attachment; filename={name}"
-    return stream_file(r["parts"], bot), 200, headers
+    headers = objectHeaders(r, b)
+    if (status := check_preconditions(request.headers, r["hash"], r["time"])) == 412:
+        return ("", 412) if head else PreconditionFailed
+    elif status == 304:
+        return "", 304, {k: v for k, v in headers.items() if k in ("ETag", "Last-Modified", "Cache-Control")}
+    if head:
+        # Part sizes are backfilled by setup_database.py, so every object is seekable.
+        headers["Content-Length"] = r["size"]
+        headers["Accept-Ranges"] = "bytes"
+        return "", 200, headers
+    if (seekable := all("size" in p for p in r["parts"])):
+        headers["Accept-Ranges"] = "bytes"
+    start, end, status = 0, None, 200
+    headers["Content-Length"] = r["size"]
+    # Zero-byte objects have no parts and no satisfiable ranges, so Range is ignored for them.
+    if seekable and r["size"] and (rng := parse_range(request.headers.get("Range"), r["size"])) is not None:
+        if not rng:
+            return InvalidRange[0], InvalidRange[1], {"Content-Range": f"bytes */{r['size']}"}
+        start, end = rng
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{r['size']}"
+        headers["Content-Length"] = end - start
+        status = 206
+    if (body := await objectBody(r, start, end)) is None:
+        return InternalError
+    return sendBody(body), status, headers
 
 @app.route("/healthcheck")
 def hc():
     return ""
 
+@app.route("/metrics")
+def metricsEndpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 if __name__ == "__main__":
     from uvicorn import run as urun
     urun('main:app', host="0.0.0.0", port=8000, reload=True, use_colors=False)
\ No newline at end of file
@@ -0,0 +1,117 @@
+from bisect import bisect_left
+from time import perf_counter
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join([f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for n, v in zip(names, values)])
+    return f"{{{pairs}}}"
+
+class Counter:
+    TYPE = "counter"
+
+    def __init__(self, name, help, labels=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} if labels else {(): 0}
+        self.callback = callback
+        _metrics.append(self)
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        if self.callback is not None:
+            self.values = self.callback()
+        for labels, value in self.values.items():
+            yield self.name, _labels(self.labels, labels), value
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, *labels, value):
+        self.values[labels] = value
+
+class Histogram:
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, *labels, value):
+        if not (series := self.values.get(labels)):
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                yield f"{self.name}_bucket", _labels(self.labels + ("le",), labels + (bound,)), cumulative
+            yield f"{self.name}_sum", _labels(self.labels, labels), total
+            yield f"{self.name}_count", _labels(self.labels, labels), count
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(*self.labels, value=perf_counter() - self.start)
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+        lines += [f"{name}{labels} {value}" for name, labels, value in metric.samples()]
+    return "\n".join(lines) + "\n"
+
+request_duration = Histogram("s3_request_duration_seconds", "Time until response headers are sent, by route.", ("route", "method", "status"))
+bytes_received = Counter("s3_bytes_received_total", "Request body bytes received for uploads.")
+bytes_sent = Counter("s3_bytes_sent_total", "Object bytes streamed to clients.")
+telegram_duration = Histogram("telegram_rpc_duration_seconds", "Telegram RPC latency.", ("method", "dc"))
+flood_waits = Counter("telegram_flood_waits_total", "FloodWait errors received, by bot.", ("bot",))
+flood_wait_seconds = Counter("telegram_flood_wait_seconds_total", "Seconds of FloodWait imposed, by bot.", ("bot",))
+stream_aborts = Counter("s3_stream_aborts_total", "Downloads that ended early, by reason.", ("reason",))
+mongo_duration = Histogram("mongo_command_duration_seconds", "MongoDB command latency.", ("command", "outcome"))
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = {}
+
+    def started(self, event):
+        self.commands[(event.connection_id, event.request_id)] = event.command_name
+
+    def _finish(self, event, outcome):
+        if (command := self.commands.pop((event.connection_id, event.request_id), None)):
+            mongo_duration.observe(command, outcome, value=event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finish(event, "success")
+
+    def failed(self, event):
+        self._finish(event, "failure")
+
+monitoring.register(MongoCommandListener())
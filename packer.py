@@ -0,0 +1,82 @@
+from asyncio import CancelledError, create_task, get_running_loop, shield, to_thread
+from hashlib import md5
+from os import environ
+from blobs import releaseParts
+from tg import upload_stream, OBJECT_PART_SIZE
+
+PACK_SIZE = min(int(environ.get("PACK_SIZE", 16 * 1024 * 1024)), OBJECT_PART_SIZE)
+PACK_THRESHOLD = min(int(environ.get("PACK_THRESHOLD", 0)), PACK_SIZE)
+PACK_DELAY = float(environ.get("PACK_DELAY", 0.5))
+
+async def _once(data):
+    yield data
+
+class Packer:
+    def __init__(self, bots, mongo, max_size=PACK_SIZE, delay=PACK_DELAY):
+        self.bots = bots
+        self.mongo = mongo
+        self.max_size = max_size
+        self.delay = delay
+        self.pending = []
+        self.size = 0
+        self.timer = None
+
+    async def add(self, data):
+        future = get_running_loop().create_future()
+        if self.size + len(data) > self.max_size:
+            self.flush()
+        self.pending.append((data, future))
+        self.size += len(data)
+        if self.size >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = get_running_loop().call_later(self.delay, self.flush)
+        try:
+            return await shield(future)
+        except CancelledError:
+            future.add_done_callback(self._abandon)
+            raise
+
+    def _abandon(self, future):
+        if not future.cancelled() and not future.exception():
+            create_task(releaseParts(self.mongo, self.bots, [future.result()]))
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending, self.size = self.pending, [], 0
+        if pending:
+            create_task(self._upload(pending))
+
+    async def _upload(self, pending):
+        data = b"".join([d for d, _ in pending])
+        try:
+            hashes = await to_thread(lambda: [md5(d).hexdigest() for d, _ in pending])
+            documents, _, _ = await upload_stream(self.bots, _once(data), len(data), part_size=max(len(data), 1))
+            document = documents[0]
+            await self.mongo.blobs.insert_one({
+                "_id": document["tg_message"],
+                "refs": len(pending),
+                "tg_file": document["tg_file"],
+                "bot": document["bot"],
+                "size": document["size"],
+                "hash": document["hash"],
+                "pack": True,
+                "live": document["size"]
+            })
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        base = 0
+        for (d, future), hash in zip(pending, hashes):
+            future.set_result({
+                "tg_file": document["tg_file"],
+                "tg_message": document["tg_message"],
+                "bot": document["bot"],
+                "size": len(d),
+                "hash": hash,
+                "base": base
+            })
+            base += len(d)
@@ -0,0 +1,166 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from asyncio import gather, run, sleep
+from argparse import ArgumentParser
+from datetime import datetime
+from os import environ
+from os.path import exists
+from time import time
+import sys
+from blobs import releaseParts, claimUploadParts, deleteMessages, DELETE_BATCH
+from tg import stream_file
+if exists(".env"):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+class Reclaimer:
+    def __init__(self, mongo, bots, upload_expiry=7 * 86400, grace=3600, batch_delay=1, packer=None, compact_ratio=0.5):
+        self.mongo = mongo
+        self.bots = bots
+        self.packer = packer
+        self.compact_ratio = compact_ratio
+        self.upload_expiry = upload_expiry
+        self.grace = grace
+        self.batch_delay = batch_delay
+        self.stats = dict.fromkeys(["runs", "uploads_expired", "objects_reclaimed", "blobs_reclaimed", "messages_scanned", "messages_deleted", "packs_compacted"], 0)
+
+    async def _release(self, parts):
+        for i in range(0, len(parts), DELETE_BATCH):
+            self.stats["messages_deleted"] += len(await releaseParts(self.mongo, self.bots, parts[i:i + DELETE_BATCH]))
+            await sleep(self.batch_delay)
+
+    async def expireUploads(self):
+        expired = []
+        async for upload in self.mongo.objects.find({"incomplete": True, "time": {"$lt": round(time()) - self.upload_expiry}}, {"uploadId": 1}):
+            if (await self.mongo.objects.delete_one({"_id": upload["_id"], "incomplete": True})).deleted_count:
+                expired.append(upload["uploadId"])
+        # Parts are stored only after their upload exists, so listing parts before live uploads cannot mistake a new upload for an orphan.
+        stored = await self.mongo.upload_parts.distinct("uploadId")
+        live = set(await self.mongo.objects.distinct("uploadId", {"incomplete": True}))
+        orphaned = [u for u in stored if u not in live and u not in expired]
+        for uploadId in expired:
+            await self._release(await claimUploadParts(self.mongo, {"uploadId": uploadId}))
+            self.stats["uploads_expired"] += 1
+        for uploadId in orphaned:
+            # Rows marked used belong to an object that CompleteMultipartUpload has promoted (or is promoting).
+            await self._release(await claimUploadParts(self.mongo, {"uploadId": uploadId, "used": {"$exists": False}}))
+            await self.mongo.upload_parts.delete_many({"uploadId": uploadId, "used": True})
+            self.stats["uploads_expired"] += 1
+
+    async def reclaimObjects(self):
+        buckets = set(await self.mongo.buckets.distinct("name"))
+        for bucket in await self.mongo.objects.distinct("bucket"):
+            if bucket in buckets:
+                continue
+            while (objects := await self.mongo.objects.find({"bucket": bucket}, {"parts": 1}).to_list(DELETE_BATCH)):
+                # The bucket may have been (re)created since the snapshot; its objects are live again.
+                if await self.mongo.buckets.find_one({"name": bucket}, {"_id": 1}):
+                    break
+                await self.mongo.objects.delete_many({"_id": {"$in": [o["_id"] for o in objects]}})
+                await self._release([p for o in objects for p in o["parts"]])
+                self.stats["objects_reclaimed"] += len(objects)
+
+    async def reclaimBlobs(self):
+        while (blobs := await self.mongo.blobs.find({"refs": {"$lte": 0}}, {"_id": 1}).to_list(DELETE_BATCH)):
+            messages = [b["_id"] for b in blobs]
+            await deleteMessages(self.bots, messages)
+            await self.mongo.blobs.delete_many({"_id": {"$in": messages}, "refs": {"$lte": 0}})
+            self.stats["blobs_reclaimed"] += len(messages)
+            self.stats["messages_deleted"] += len(messages)
+            await sleep(self.batch_delay)
+
+    async def _repack(self, obj_id, part):
+        data = b"".join([chunk async for chunk in stream_file([{**part, "part_id": 0, "offset": 0}], self.bots)])
+        if len(data) != part["size"]:
+            return
+        new = await self.packer.add(data)
+        result = await self.mongo.objects.update_one(
+            {"_id": obj_id, "parts": {"$elemMatch": {"tg_message": part["tg_message"], "base": part["base"], "part_id": part["part_id"]}}},
+            {"$set": {"parts.$": {**part, **new}}}
+        )
+        await releaseParts(self.mongo, self.bots, [part] if result.modified_count else [new])
+
+    async def compactPacks(self):
+        if self.packer is None:
+            return
+        query = {"pack": True, "refs": {"$gt": 0}, "$expr": {"$lt": ["$live", {"$multiply": ["$size", self.compact_ratio]}]}}
+        while (packs := await self.mongo.blobs.find(query, {"_id": 1}).to_list(10)):
+            for pack in packs:
+                jobs = []
+                async for obj in self.mongo.objects.find({"parts.tg_message": pack["_id"]}, {"parts": 1}):
+                    jobs += [self._repack(obj["_id"], p) for p in obj["parts"] if p["tg_message"] == pack["_id"]]
+                await gather(*jobs)
+                self.stats["packs_compacted"] += 1
+                await sleep(self.batch_delay)
+            if any([await self.mongo.blobs.find_one({"_id": p["_id"], **query}) for p in packs]):
+                break
+
+    async def _referenced(self):
+        referenced = set(await self.mongo.blobs.distinct("_id"))
+        referenced.update(await self.mongo.objects.distinct("parts.tg_message"))
+        referenced.update(await self.mongo.upload_parts.distinct("documents.tg_message"))
+        return referenced
+
+    async def _latestMessage(self):
+        # Bots cannot read chat history, so post a marker to learn the newest message id.
+        marker = await self.bots.run(lambda c: c.send_message(self.bots.chat_id, "reclaimer scan"))
+        await self.bots.delete_messages([marker.id])
+        return marker.id
+
+    async def scanMessages(self):
+        referenced = await self._referenced()
+        latest = await self._latestMessage()
+        deadline = time() - self.grace
+        for start in range(1, latest, 200):
+            ids = [i for i in range(start, min(start + 200, latest)) if i not in referenced]
+            if not ids:
+                continue
+            messages = await self.bots.run(lambda c: c.get_messages(self.bots.chat_id, ids))
+            self.stats["messages_scanned"] += len(ids)
+            orphaned = [m.id for m in messages if not m.empty and m.document and _timestamp(m.date) < deadline]
+            if orphaned:
+                await deleteMessages(self.bots, orphaned)
+                self.stats["messages_deleted"] += len(orphaned)
+            await sleep(self.batch_delay)
+
+    async def runOnce(self, scan_messages=False):
+        await self.expireUploads()
+        await self.reclaimObjects()
+        await self.compactPacks()
+        await self.reclaimBlobs()
+        if scan_messages:
+            await self.scanMessages()
+        self.stats["runs"] += 1
+
+    async def runForever(self, interval):
+        while True:
+            try:
+                await self.runOnce()
+            except Exception as e:
+                print(f"Reclaimer run failed: {e}", file=sys.stderr)
+            await sleep(interval)
+
+def _timestamp(date):
+    return date.timestamp() if isinstance(date, datetime) else date
+
+async def main():
+    parser = ArgumentParser(description="Delete expired uploads and unreferenced telegram messages.")
+    parser.add_argument("--scan-messages", action="store_true", help="also scan the channel for documents that are not referenced by any object")
+    parser.add_argument("--upload-expiry", type=int, default=int(environ.get("UPLOAD_EXPIRY", 7 * 86400)), help="seconds after which incomplete multipart uploads are removed")
+    parser.add_argument("--batch-delay", type=float, default=float(environ.get("GC_BATCH_DELAY", 1)), help="seconds to wait between deletion batches")
+    args = parser.parse_args()
+    from bots import BotPool
+    from packer import Packer, PACK_THRESHOLD
+    mongo = AsyncIOMotorClient(environ.get("MONGODB")).s3
+    tokens = [t.strip() for t in environ.get("BOT_TOKENS", environ.get("BOT_TOKEN", "")).split(",") if t.strip()]
+    bots = BotPool(tokens, int(environ.get("API_ID", 0)), environ.get("API_HASH"), int(environ.get("CHAT_ID")))
+    await bots.start()
+    try:
+        reclaimer = Reclaimer(mongo, bots, args.upload_expiry, batch_delay=args.batch_delay, packer=Packer(bots, mongo) if PACK_THRESHOLD > 0 else None)
+        await reclaimer.runOnce(args.scan_messages)
+    finally:
+        await bots.stop()
+    for name, value in reclaimer.stats.items():
+        print(f"{name}: {value}")
+
+if __name__ == "__main__":
+    run(main())
@@ -1,17 +1,31 @@
+from xml.sax.saxutils import escape as escapeXML
+
 class s3Type:
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.INNER = "".join([f"<{f}>{{{f}}}</{f}>" for f in cls.FIELDS])
+
+    def _values(self):
+        values = {}
+        for k in self.FIELDS:
+            if (v := getattr(self, k)) is None:
+                values[k] = ""
+            elif isinstance(v, s3Type):
+                values[k] = v.innerXML()
+            else:
+                values[k] = escapeXML(str(v))
+        return values
+
+    def innerXML(self, removeNone=False):
+        if not removeNone:
+            return self.INNER.format_map(self._values())
+        values = self._values()
+        return "".join([f"<{k}>{values[k]}</{k}>" for k in self.FIELDS if getattr(self, k) is not None])
+
     def toXML(self, removeNone=False):
-        xml = f"<{self.__class__.__name__}>"
-        for k,v in self.__dict__.items():
-            if v is None:
-                if removeNone:
-                    continue
-                v = ""
-            if isinstance(v, s3Type):
-                xml += v.toXML()
-                continue
-            xml += f"<{k}>{v}</{k}>"
-        xml += f"</{self.__class__.__name__}>"
-        return xml
+        return f"<{self.__class__.__name__}>{self.innerXML(removeNone)}</{self.__class__.__name__}>"
 
 class User:
     def __init__(self, id, name):
@@ -19,25 +33,39 @@ class User:
         self.name = name
 
 class Owner(s3Type, User):
+    FIELDS = ("ID", "DisplayName")
+
     def __init__(self, id, name):
         self.ID = id
         self.DisplayName = name
 
 class Bucket(s3Type):
+    FIELDS = ("Name", "CreationDate")
+
     def __init__(self, name, creation_date):
         self.Name = name
         self.CreationDate = creation_date
 
 class Contents(s3Type):
+    FIELDS = ("Key", "ETag", "LastModified", "Owner", "StorageClass", "Size")
+
     def __init__(self, name, md5, owner, size, last_modified):
         self.Key = name
         self.ETag = md5
         self.LastModified = last_modified
         self.Owner = owner
-        self.StorageClass = "STANDART"
+        self.StorageClass = "STANDARD"
         self.Size = size
 
+class Deleted(s3Type):
+    FIELDS = ("Key",)
+
+    def __init__(self, key):
+        self.Key = key
+
 class Error(s3Type):
+    FIELDS = ("Code", "Message", "Resource")
+
     def __init__(self, code, message, resource=None):
         self.Code = code
         self.Message = message
@@ -47,6 +75,8 @@ class Error(s3Type):
         return "<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>{body}".format(body=self.toXML(removeNone=True))
 
 RESULT_PAYLOAD = "<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?><{resultName} xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">{body}</{resultName}>"
+RESULT_HEAD = "<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?><{resultName} xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">"
+RESULT_TAIL = "</{resultName}>"
 
 class ListAllMyBucketsResult:
     BODY = "{owner}<Buckets>{buckets}</Buckets>"
@@ -68,10 +98,17 @@ class VersioningConfiguration:
     def gen(self):
         return RESULT_PAYLOAD.format(resultName=self.__class__.__name__, body="<Status>Disabled</Status>")
 
+class CommonPrefixes(s3Type):
+    FIELDS = ("Prefix",)
+
+    def __init__(self, prefix):
+        self.Prefix = prefix
+
 class ListBucketResult:
-    BODY = "{items}<EncodingType>{etype}</EncodingType><IsTruncated>{is_trunc}</IsTruncated><MaxKeys>{max_keys}</MaxKeys><Name>{name}</Name><Prefix>{prefix}</Prefix><Marker>{marker}</Marker>"
+    TRAILER = "<IsTruncated>{is_trunc}</IsTruncated><MaxKeys>{max_keys}</MaxKeys><Name>{name}</Name><Prefix>{prefix}</Prefix>{extra}"
+    BATCH = 100
 
-    def __init__(self, items, name, etype="url", is_trunc=False, max_keys=1000, prefix=None, marker=None):
+    def __init__(self, items, name, etype=None, is_trunc=False, max_keys=1000, prefix=None, marker=None, delimiter=None, next_marker=None, v2=False, continuation_token=None, next_continuation_token=None, start_after=None):
         self.items = items
         self.etype = etype
         self.is_trunc = is_trunc
@@ -79,18 +116,59 @@ class ListBucketResult:
         self.max_keys = max_keys
         self.prefix = prefix
         self.marker = marker
+        self.delimiter = delimiter
+        self.next_marker = next_marker
+        self.v2 = v2
+        self.continuation_token = continuation_token
+        self.next_continuation_token = next_continuation_token
+        self.start_after = start_after
+        self.key_count = 0
 
-    def gen(self):
+    def _trailer(self):
         d = {}
-        d["items"] = "".join([i.toXML() for i in self.items])
-        d["etype"] = self.etype
         d["is_trunc"] = "true" if self.is_trunc else "false"
         d["max_keys"] = str(self.max_keys)
-        d["name"] = self.name
-        d["prefix"] = self.prefix if self.prefix is not None else ""
-        d["marker"] = self.marker if self.marker is not None else ""
+        d["name"] = escapeXML(self.name)
+        d["prefix"] = escapeXML(self.prefix) if self.prefix is not None else ""
+        extra = {}
+        if self.delimiter:
+            extra["Delimiter"] = self.delimiter
+        if self.etype:
+            extra["EncodingType"] = self.etype
+        if self.v2:
+            extra["KeyCount"] = self.key_count
+            extra["ContinuationToken"] = self.continuation_token
+            extra["NextContinuationToken"] = self.next_continuation_token
+            extra["StartAfter"] = self.start_after
+        else:
+            extra["Marker"] = self.marker if self.marker is not None else ""
+            extra["NextMarker"] = self.next_marker
+        d["extra"] = "".join([f"<{k}>{escapeXML(str(v))}</{k}>" for k, v in extra.items() if v is not None])
+        return self.TRAILER.format(**d)
 
-        return RESULT_PAYLOAD.format(resultName=self.__class__.__name__, body=self.BODY.format(**d))
+    async def stream(self):
+        yield RESULT_HEAD.format(resultName=self.__class__.__name__).encode("utf8")
+        batch = []
+        async for item in self.items:
+            batch.append(item.toXML())
+            self.key_count += 1
+            if len(batch) == self.BATCH:
+                yield "".join(batch).encode("utf8")
+                batch = []
+        yield ("".join(batch) + self._trailer() + RESULT_TAIL.format(resultName=self.__class__.__name__)).encode("utf8")
+
+class CopyObjectResult(s3Type):
+    FIELDS = ("LastModified", "ETag")
+
+    def __init__(self, md5, last_modified):
+        self.LastModified = last_modified
+        self.ETag = f"\"{md5}\""
+
+    def gen(self):
+        return RESULT_PAYLOAD.format(resultName=self.__class__.__name__, body=self.innerXML())
+
+class CopyPartResult(CopyObjectResult):
+    pass
 
 class CompleteMultipartUploadResult:
     BODY = "<Bucket>{bucket}</Bucket><ETag>\"{hash}\"</ETag><Key>{name}</Key><Location>/{bucket}/{name}</Location>"
@@ -102,8 +180,8 @@ class CompleteMultipartUploadResult:
 
     def gen(self):
         d = {}
-        d["bucket"] = self.bucket
-        d["name"] = self.name
+        d["bucket"] = escapeXML(self.bucket)
+        d["name"] = escapeXML(self.name)
         d["hash"] = self.hash
 
         return RESULT_PAYLOAD.format(resultName=self.__class__.__name__, body=self.BODY.format(**d))
@@ -118,14 +196,73 @@ class InitiateMultipartUploadResult:
 
     def gen(self):
         d = {}
-        d["bucket"] = self.bucket
-        d["name"] = self.name
+        d["bucket"] = escapeXML(self.bucket)
+        d["name"] = escapeXML(self.name)
         d["uploadId"] = self.uploadId
 
         return RESULT_PAYLOAD.format(resultName=self.__class__.__name__, body=self.BODY.format(**d))
 
+class Part(s3Type):
+    FIELDS = ("PartNumber", "LastModified", "ETag", "Size")
+
+    def __init__(self, number, last_modified, md5, size):
+        self.PartNumber = number
+        self.LastModified = last_modified
+        self.ETag = f"\"{md5}\""
+        self.Size = size
+
+class ListPartsResult:
+    BODY = "<Bucket>{bucket}</Bucket><Key>{name}</Key><UploadId>{uploadId}</UploadId>{owner}<StorageClass>STANDARD</StorageClass><PartNumberMarker>{marker}</PartNumberMarker>{next_marker}<MaxParts>{max_parts}</MaxParts><IsTruncated>{is_trunc}</IsTruncated>{parts}"
+
+    def __init__(self, bucket, name, uploadId, parts, marker, max_parts, is_trunc, owner):
+        self.bucket = bucket
+        self.name = name
+        self.uploadId = uploadId
+        self.parts = parts
+        self.marker = marker
+        self.max_parts = max_parts
+        self.is_trunc = is_trunc
+        self.owner = owner
+
+    def gen(self):
+        d = {}
+        d["bucket"] = escapeXML(self.bucket)
+        d["name"] = escapeXML(self.name)
+        d["uploadId"] = self.uploadId
+        d["owner"] = f"{self.owner.toXML()}<Initiator>{self.owner.innerXML()}</Initiator>"
+        d["marker"] = self.marker
+        d["next_marker"] = f"<NextPartNumberMarker>{self.parts[-1].PartNumber}</NextPartNumberMarker>" if self.parts else ""
+        d["max_parts"] = self.max_parts
+        d["is_trunc"] = "true" if self.is_trunc else "false"
+        d["parts"] = "".join([p.toXML() for p in self.parts])
+
+        return RESULT_PAYLOAD.format(resultName=self.__class__.__name__, body=self.BODY.format(**d))
+
+class DeleteResult:
+    def __init__(self, deleted):
+        self.deleted = deleted
+
+    def gen(self):
+        return RESULT_PAYLOAD.format(resultName=self.__class__.__name__, body="".join([d.toXML() for d in self.deleted]))
+
 NoSuchBucket = (Error("NoSuchBucket", f"The specified bucket does not exist").gen(), 404)
 InvalidBucketName = (Error("InvalidBucketName", "Invalid characters in bucketName or bucketName has invalid length (must be 1-255)").gen(), 400)
 BucketAlreadyExists = (Error("BucketAlreadyExists", "Bucket name is already in use!").gen(), 409)
 InvalidAccessKeyId = (Error("InvalidAccessKeyId", "Malformed Access Key Id").gen(), 403)
 SignatureDoesNotMatch = (Error("SignatureDoesNotMatch", "Signature validation failed").gen(), 403)
+PreconditionFailed = (Error("PreconditionFailed", "At least one of the pre-conditions you specified did not hold").gen(), 412)
+InvalidRange = (Error("InvalidRange", "The requested range is not satisfiable").gen(), 416)
+MissingContentLength = (Error("MissingContentLength", "You must provide the Content-Length HTTP header").gen(), 411)
+IncompleteBody = (Error("IncompleteBody", "You did not provide the number of bytes specified by the Content-Length HTTP header").gen(), 400)
+BadDigest = (Error("BadDigest", "The Content-MD5 you specified did not match what was received").gen(), 400)
+XAmzContentSHA256Mismatch = (Error("XAmzContentSHA256Mismatch", "The provided 'x-amz-content-sha256' header does not match what was computed").gen(), 400)
+InvalidArgument = (Error("InvalidArgument", "Invalid argument").gen(), 400)
+MalformedXML = (Error("MalformedXML", "The XML you provided was not well-formed or did not validate against our published schema").gen(), 400)
+NoSuchKey = (Error("NoSuchKey", "The specified key does not exist").gen(), 404)
+UnsupportedContentSHA256 = (Error("NotImplemented", "The x-amz-content-sha256 payload mode you provided is not supported").gen(), 501)
+CopySourceNotSeekable = (Error("NotImplemented", "Part copies are not supported for this source object, copy the whole object instead").gen(), 501)
+InternalError = (Error("InternalError", "We encountered an internal error. Please try again").gen(), 500)
+NoSuchUpload = (Error("NoSuchUpload", "The specified multipart upload does not exist").gen(), 404)
+InvalidPart = (Error("InvalidPart", "One or more of the specified parts could not be found or the ETag did not match").gen(), 400)
+InvalidPartOrder = (Error("InvalidPartOrder", "The list of parts was not in ascending order").gen(), 400)
+BucketNotEmpty = (Error("BucketNotEmpty", "The bucket you tried to delete is not empty").gen(), 409)
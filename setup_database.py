@@ -1,18 +1,162 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING
+from pymongo.errors import CollectionInvalid, OperationFailure
 from asyncio import run
+from argparse import ArgumentParser
 from os import environ
 from os.path import exists
 if exists(".env"):
     from dotenv import load_dotenv
     load_dotenv()
 
+async def createCollections(mongo):
+    for collection in ["users", "buckets", "objects", "blobs", "upload_parts"]:
+        try:
+            await mongo.create_collection(collection)
+        except CollectionInvalid:
+            pass
+
+async def removeDuplicateObjects(mongo):
+    duplicates = mongo.objects.aggregate([
+        {"$match": {"hash": {"$type": "string"}}},
+        {"$sort": {"time": -1, "_id": -1}},
+        {"$group": {"_id": {"bucket": "$bucket", "name": "$name"}, "ids": {"$push": "$_id"}, "messages": {"$push": "$parts.tg_message"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ], allowDiskUse=True)
+    async for group in duplicates:
+        key = group["_id"]
+        # Only the newest copy was reachable; the older ones are dropped and their messages left for `reclaimer.py --scan-messages`.
+        messages = [m for parts in group["messages"][1:] for m in parts]
+        print(f"Removing {len(group['ids']) - 1} older copies of {key['bucket']}/{key['name']} (unreferenced messages: {messages})")
+        await mongo.objects.delete_many({"_id": {"$in": group["ids"][1:]}})
+
+async def createIndexes(mongo):
+    await removeDuplicateObjects(mongo)
+    await mongo.users.create_index("id", unique=True)
+    await mongo.buckets.create_index("name", unique=True)
+    await mongo.buckets.create_index("owner")
+    await mongo.objects.create_index([("owner", ASCENDING), ("bucket", ASCENDING), ("name", ASCENDING)])
+    await mongo.objects.create_index([("bucket", ASCENDING), ("name", ASCENDING)], unique=True, name="bucket_name_complete", partialFilterExpression={"hash": {"$type": "string"}})
+    await mongo.objects.create_index("uploadId", unique=True, sparse=True)
+
+async def backfillPartSizes(mongo):
+    bots = None
+    async for obj in mongo.objects.find({"parts": {"$elemMatch": {"size": {"$exists": False}}}}, {"parts": 1, "size": 1}):
+        parts = obj["parts"]
+        if len(parts) == 1:
+            parts[0]["size"] = obj["size"]
+        else:
+            if bots is None:
+                from bots import BotPool
+                tokens = [t.strip() for t in environ.get("BOT_TOKENS", environ.get("BOT_TOKEN", "")).split(",") if t.strip()]
+                bots = BotPool(tokens, int(environ.get("API_ID", 0)), environ.get("API_HASH"), int(environ.get("CHAT_ID")))
+                await bots.start()
+            for part in parts:
+                if "size" not in part:
+                    message = await bots.clients[0].get_messages(bots.chat_id, part["tg_message"])
+                    part["size"] = message.document.file_size
+        offset = 0
+        for part in sorted(parts, key=lambda x: (x["part_id"], x.get("index", 0))):
+            part["offset"] = offset
+            offset += part["size"]
+        await mongo.objects.update_one({"_id": obj["_id"]}, {"$set": {"parts": parts}})
+    if bots is not None:
+        await bots.stop()
+
+async def createBlobIndexes(mongo):
+    await createCollections(mongo)
+    await mongo.blobs.create_index([("hash", ASCENDING), ("size", ASCENDING)])
+
+async def createPartTable(mongo):
+    await createCollections(mongo)
+    await mongo.upload_parts.create_index([("uploadId", ASCENDING), ("part_id", ASCENDING)], unique=True)
+    async for obj in mongo.objects.find({"incomplete": True, "parts.0": {"$exists": True}}, {"parts": 1, "uploadId": 1, "time": 1, "mime_type": 1}):
+        grouped = {}
+        for part in sorted(obj["parts"], key=lambda x: (x["part_id"], x.get("index", 0))):
+            grouped.setdefault(part["part_id"], []).append({k: v for k, v in part.items() if k not in ("part_id", "index", "offset")})
+        for number, documents in grouped.items():
+            await mongo.upload_parts.update_one({"uploadId": obj["uploadId"], "part_id": number}, {"$setOnInsert": {
+                "time": obj["time"],
+                "size": sum(d.get("size", 0) for d in documents),
+                "etag": documents[0].get("hash") if len(documents) == 1 else None,
+                "mime_type": obj["mime_type"] if number == 1 else None,
+                "documents": documents
+            }}, upsert=True)
+        await mongo.objects.update_one({"_id": obj["_id"]}, {"$set": {"parts": []}})
+
+async def createPackIndexes(mongo):
+    await mongo.objects.create_index("parts.tg_message")
+    await mongo.blobs.create_index("pack", sparse=True)
+
+async def createSpoolIndex(mongo):
+    await mongo.objects.create_index("spool", sparse=True)
+
+async def createBlobDigestIndex(mongo):
+    await mongo.blobs.create_index([("owner", ASCENDING), ("sha256", ASCENDING), ("size", ASCENDING)], sparse=True)
+    try:
+        await mongo.blobs.drop_index([("hash", ASCENDING), ("size", ASCENDING)])
+    except OperationFailure:
+        pass
+
+MIGRATIONS = [
+    createCollections,
+    createIndexes,
+    backfillPartSizes,
+    createBlobIndexes,
+    createPartTable,
+    createPackIndexes,
+    createSpoolIndex,
+    createBlobDigestIndex,
+]
+
+HOT_QUERIES = [
+    ("users by id", "users", {"id": ""}, None),
+    ("bucket by name", "buckets", {"name": ""}, None),
+    ("buckets by owner", "buckets", {"owner": ""}, None),
+    ("object by name", "objects", {"bucket": "", "name": "", "incomplete": {"$exists": False}}, None),
+    ("upload by id", "objects", {"uploadId": ""}, None),
+    ("upload parts", "upload_parts", {"uploadId": "", "part_id": {"$gt": 0}}, "part_id"),
+    ("objects by message", "objects", {"parts.tg_message": 0}, None),
+    ("spooled objects", "objects", {"spool": {"$exists": True}}, None),
+    ("blob by digest", "blobs", {"owner": "", "sha256": "", "size": 0, "refs": {"$gt": 0}}, None),
+    ("list objects", "objects", {"owner": "", "bucket": "", "incomplete": {"$exists": False}, "name": {"$gt": "", "$regex": "^a"}}, "name"),
+]
+
+def describePlan(plan):
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if (index := plan.get("indexName")):
+            stage += f"({index})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " <- ".join(stages)
+
+async def migrate(mongo):
+    meta = await mongo.meta.find_one({"_id": "schema"}) or {"version": 0}
+    for version, migration in enumerate(MIGRATIONS[meta["version"]:], meta["version"] + 1):
+        print(f"Applying migration {version}: {migration.__name__}")
+        await migration(mongo)
+        await mongo.meta.update_one({"_id": "schema"}, {"$set": {"version": version}}, upsert=True)
+    print(f"Database schema is at version {len(MIGRATIONS)}")
+
+async def explain(mongo):
+    for name, collection, query, sort in HOT_QUERIES:
+        cursor = mongo[collection].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort, 1)
+        plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+        print(f"{name}: {describePlan(plan)}")
+
 async def main():
+    parser = ArgumentParser(description="Create and migrate the s3 database.")
+    parser.add_argument("--explain", action="store_true", help="print query plans of hot queries instead of migrating")
+    args = parser.parse_args()
     mongo = AsyncIOMotorClient(environ.get("MONGODB")).s3
-    for collection in ["users", "buckets", "objects"]:
-    	try:
-    		await mongo.create_collection(collection)
-    	except:
-    		pass
+    if args.explain:
+        await explain(mongo)
+    else:
+        await migrate(mongo)
 
 if __name__ == "__main__":
-    run(main())
\ No newline at end of file
+    run(main())
@@ -0,0 +1,203 @@
+from asyncio import Queue, create_task, sleep, to_thread
+from hashlib import md5
+from os import O_RDONLY, close, environ, fsync, link, makedirs, remove, replace, scandir
+from os import open as open_fd
+from os.path import exists, join
+from uuid import uuid4
+import sys
+from pyrogram.errors import FloodWait
+from blobs import releaseParts
+from packer import PACK_THRESHOLD
+from tg import upload_stream, UploadSizeMismatch, CHUNK_SIZE, SNIFF_SIZE
+
+SPOOL_WORKERS = max(int(environ.get("SPOOL_WORKERS", 2)), 1)
+SPOOL_SIZE = int(environ.get("SPOOL_SIZE", 10 * 1024 * 1024 * 1024))
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 300
+
+class Spool:
+    def __init__(self, path, bots, mongo, register, packer=None, workers=SPOOL_WORKERS, max_size=SPOOL_SIZE):
+        self.path = path
+        self.bots = bots
+        self.mongo = mongo
+        self.register = register
+        self.packer = packer
+        self.workers = workers
+        self.max_size = max_size
+        self.sizes = {}
+        self.size = 0
+        self.queue = Queue()
+        makedirs(path, exist_ok=True)
+
+    def _file(self, spool_id):
+        return join(self.path, spool_id)
+
+    def _reserve(self, spool_id, size):
+        self.sizes[spool_id] = size
+        self.size += size
+
+    def _remove(self, spool_id):
+        self.size -= self.sizes.pop(spool_id, 0)
+        try:
+            remove(self._file(spool_id))
+        except OSError:
+            pass
+
+    def accepts(self, size):
+        return size is not None and self.size + size <= self.max_size
+
+    def _sync_dir(self):
+        fd = open_fd(self.path, O_RDONLY)
+        try:
+            fsync(fd)
+        finally:
+            close(fd)
+
+    def _append(self, f, data, checksum):
+        checksum.update(data)
+        f.write(data)
+
+    def _sync(self, f, data, checksum, tmp, spool_id):
+        self._append(f, data, checksum)
+        f.flush()
+        fsync(f.fileno())
+        f.close()
+        replace(tmp, self._file(spool_id))
+        self._sync_dir()
+
+    def _discard(self, f, tmp):
+        f.close()
+        try:
+            remove(tmp)
+        except OSError:
+            pass
+
+    async def write(self, chunks, size):
+        spool_id = uuid4().hex
+        tmp = self._file(spool_id) + ".tmp"
+        checksum = md5()
+        head = b""
+        buf = bytearray()
+        received = 0
+        self._reserve(spool_id, size)
+        f = await to_thread(open, tmp, "wb")
+        try:
+            async for chunk in chunks:
+                received += len(chunk)
+                if received > size:
+                    raise UploadSizeMismatch
+                if len(head) < SNIFF_SIZE:
+                    head += chunk[:SNIFF_SIZE - len(head)]
+                buf += chunk
+                if len(buf) >= CHUNK_SIZE:
+                    data, buf = bytes(buf), bytearray()
+                    await to_thread(self._append, f, data, checksum)
+            if received != size:
+                raise UploadSizeMismatch
+            await to_thread(self._sync, f, bytes(buf), checksum, tmp, spool_id)
+        except BaseException:
+            await to_thread(self._discard, f, tmp)
+            self._remove(spool_id)
+            raise
+        return spool_id, checksum.hexdigest(), head
+
+    def discard(self, spool_id):
+        self._remove(spool_id)
+
+    async def link(self, spool_id):
+        if spool_id not in self.sizes:
+            return None
+        new_id = uuid4().hex
+        try:
+            await to_thread(self._link, spool_id, new_id)
+        except OSError:
+            return None
+        self._reserve(new_id, self.sizes[spool_id])
+        return new_id
+
+    def _link(self, spool_id, new_id):
+        link(self._file(spool_id), self._file(new_id))
+        self._sync_dir()
+
+    async def open(self, spool_id):
+        try:
+            return await to_thread(open, self._file(spool_id), "rb")
+        except FileNotFoundError:
+            return None
+
+    async def stream(self, f, start=0, end=None):
+        try:
+            await to_thread(f.seek, start)
+            while end is None or start < end:
+                data = await to_thread(f.read, CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - start))
+                if not data:
+                    break
+                start += len(data)
+                yield data
+        finally:
+            f.close()
+
+    def enqueue(self, spool_id):
+        self.queue.put_nowait(spool_id)
+
+    async def _chunks(self, spool_id):
+        async for data in self.stream(await to_thread(open, self._file(spool_id), "rb")):
+            yield data
+
+    async def _commit(self, spool_id):
+        if not (obj := await self.mongo.objects.find_one({"spool": spool_id}, {"size": 1, "owner": 1})):
+            self._remove(spool_id)
+            return
+        if not exists(self._file(spool_id)):
+            print(f"Spooled upload {spool_id} is missing from {self.path}", file=sys.stderr)
+            return
+        if self.packer and 0 < obj["size"] <= PACK_THRESHOLD:
+            data = b"".join([chunk async for chunk in self._chunks(spool_id)])
+            if len(data) != obj["size"]:
+                raise UploadSizeMismatch
+            documents = [await self.packer.add(data)]
+        else:
+            documents, _, _ = await upload_stream(self.bots, self._chunks(spool_id), obj["size"])
+            documents = [await self.register(d, obj["owner"]) for d in documents]
+        parts = []
+        offset = 0
+        for i, document in enumerate(documents):
+            parts.append({"part_id": i, **document, "offset": offset})
+            offset += document["size"]
+        result = await self.mongo.objects.update_one({"_id": obj["_id"], "spool": spool_id}, {"$set": {"parts": parts}, "$unset": {"spool": 1}})
+        if not result.modified_count:
+            await releaseParts(self.mongo, self.bots, documents)
+        self._remove(spool_id)
+
+    async def _work(self):
+        while True:
+            spool_id = await self.queue.get()
+            delay = RETRY_DELAY
+            while True:
+                try:
+                    await self._commit(spool_id)
+                    break
+                except FloodWait as e:
+                    wait = e.value
+                except Exception as e:
+                    print(f"Spooled upload {spool_id} failed, retrying in {delay}s: {e!r}", file=sys.stderr)
+                    wait, delay = delay, min(delay * 2, MAX_RETRY_DELAY)
+                await sleep(wait)
+
+    async def recover(self):
+        pending = {}
+        async for obj in self.mongo.objects.find({"spool": {"$exists": True}}, {"spool": 1, "size": 1}):
+            pending[obj["spool"]] = obj["size"]
+        for entry in scandir(self.path):
+            if entry.is_file() and entry.name not in pending:
+                remove(entry.path)
+        for spool_id, size in pending.items():
+            if not exists(self._file(spool_id)):
+                print(f"Spooled upload {spool_id} is missing from {self.path}", file=sys.stderr)
+                continue
+            self._reserve(spool_id, size)
+            self.enqueue(spool_id)
+
+    def start(self):
+        for _ in range(self.workers):
+            create_task(self._work())
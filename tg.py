@@ -1,53 +1,336 @@
+from asyncio import Lock, Semaphore, create_task, gather
+from collections import deque
+from itertools import chain
+from os import environ
+from cache import chunk_cache, cache_uploads
+from utils import update_digests
+from pyrogram.errors import AuthBytesInvalid
 from pyrogram.file_id import FileId
 from pyrogram.session import Session, Auth
-from pyrogram.raw.functions.upload import GetFile
+from pyrogram.raw.functions.upload import GetFile, SaveFilePart, SaveBigFilePart
 from pyrogram.raw.functions.auth import ImportAuthorization, ExportAuthorization
-from pyrogram.raw.types import InputDocumentFileLocation
+from pyrogram.raw.functions.messages import SendMedia
+from pyrogram.raw.types import InputDocumentFileLocation, InputFile, InputFileBig, InputMediaUploadedDocument, DocumentAttributeFilename, UpdateNewMessage, UpdateNewChannelMessage
+from pyrogram.types import Message
+from hashlib import md5, sha256
+from metrics import telegram_duration, stream_aborts
+import logging
+
+CHUNK_SIZE = 1024 * 1024
+PREFETCH_CHUNKS = max(int(environ.get("DOWNLOAD_PREFETCH", 4)), 1)
+UPLOAD_PART_SIZE = 512 * 1024
+BIG_FILE_SIZE = 10 * 1024 * 1024
+SNIFF_SIZE = 2048
+OBJECT_PART_SIZE = max(int(environ.get("OBJECT_PART_SIZE", 128 * 1024 * 1024)) // UPLOAD_PART_SIZE, 1) * UPLOAD_PART_SIZE
+UPLOAD_WORKERS = max(int(environ.get("UPLOAD_WORKERS", 4)), 1)
+MEDIA_SESSIONS = max(int(environ.get("MEDIA_SESSIONS_PER_DC", 2)), 1)
+
+log = logging.getLogger(__name__)
 
 class File:
-    def __init__(self, id, client):
-        self.id = FileId.decode(id)
+    def __init__(self, part, bots):
+        self.part = part
+        self.id = FileId.decode(part["tg_file"])
+        self.bots = bots
+        self.base = part.get("base", 0)
+
+    async def _read(self, client, offset):
+        file_id = await self.bots.file_id(client, self.part)
+        location = InputDocumentFileLocation(id=file_id.media_id, access_hash=file_id.access_hash, file_reference=file_id.file_reference, thumb_size=file_id.thumbnail_size)
+        pool = get_media_pool(client, file_id.dc_id)
+        return (await pool.send(GetFile(location=location, offset=offset, limit=CHUNK_SIZE))).bytes
+
+    async def _fetch(self, offset):
+        return await self.bots.run(lambda client: self._read(client, offset), prefer=self.part.get("bot"))
+
+    async def read(self, offset):
+        if chunk_cache is None:
+            return await self._fetch(offset)
+        return await chunk_cache.get((self.id.media_id, offset), lambda: self._fetch(offset))
+
+    def chunks(self, start=0, end=None, done=()):
+        start += self.base
+        end = None if end is None else end + self.base
+        offset = start - start % CHUNK_SIZE
+        skip = start - offset
+        while (end is None or offset < end) and self not in done:
+            yield self, offset, skip, None if end is None else min(end - offset, CHUNK_SIZE)
+            offset += CHUNK_SIZE
+            skip = 0
+
+    async def stream(self, start=0, end=None, window=PREFETCH_CHUNKS):
+        done = set()
+        async for chunk in prefetch(self.chunks(start, end, done), done, window):
+            yield chunk
+
+class ShortRead(Exception):
+    pass
+
+async def prefetch(plan, done, window=PREFETCH_CHUNKS):
+    queue = deque()
+
+    def fill():
+        while len(queue) < window and (job := next(plan, None)):
+            queue.append((job, create_task(job[0].read(job[1]))))
+
+    file = offset = None
+    try:
+        fill()
+        while queue:
+            (file, offset, skip, take), task = queue.popleft()
+            if file in done:
+                task.cancel()
+                continue
+            data = await task
+            if take is None:
+                if len(data) != CHUNK_SIZE:
+                    done.add(file)
+            elif len(data) < take:
+                raise ShortRead(f"expected {take} bytes, got {len(data)}")
+            if (data := data[skip:take]):
+                yield data
+            fill()
+    except Exception:
+        stream_aborts.inc("upstream")
+        log.exception(f"Failed to fetch chunk at offset {offset} of message {file.part.get('tg_message') if file else None}, aborting stream")
+        raise
+    finally:
+        for _, task in queue:
+            task.cancel()
+
+class MediaSessionPool:
+    def __init__(self, client, dc_id, size=MEDIA_SESSIONS):
         self.client = client
+        self.dc_id = dc_id
+        self.size = size
+        self.sessions = []
+        self.busy = {}
+        self.auth_key = None
+        self.lock = Lock()
+
+    async def _authorize(self):
+        test_mode = await self.client.storage.test_mode()
+        if self.dc_id == await self.client.storage.dc_id():
+            self.auth_key = await self.client.storage.auth_key()
+            return None
+        auth_key = await Auth(self.client, self.dc_id, test_mode).create()
+        session = Session(self.client, self.dc_id, auth_key, test_mode, is_media=True)
+        await session.start()
+        for _ in range(6):
+            exported_auth = await self.client.invoke(ExportAuthorization(dc_id=self.dc_id))
+            try:
+                await session.invoke(ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
+                break
+            except AuthBytesInvalid:
+                continue
+        else:
+            await session.stop()
+            raise AuthBytesInvalid
+        self.auth_key = auth_key
+        return session
 
-    async def stream(self):
-        session = await get_media_session(self.client, self.id)
-        loc = InputDocumentFileLocation(id=self.id.media_id, access_hash=self.id.access_hash, file_reference=self.id.file_reference, thumb_size=self.id.thumbnail_size)
-        offset = 0
+    async def _create(self):
+        session = await self._authorize() if self.auth_key is None else None
+        if session is None:
+            session = Session(self.client, self.dc_id, self.auth_key, await self.client.storage.test_mode(), is_media=True)
+            await session.start()
+        self.sessions.append(session)
+        self.busy[session] = 0
+        return session
+
+    async def _discard(self, session):
+        if session not in self.busy:
+            return
+        self.sessions.remove(session)
+        del self.busy[session]
         try:
-            while (data := (await session.send(GetFile(location=loc, offset=offset, limit=1024*1024))).bytes):
-                offset += len(data)
-                yield data
-                if len(data) != 1024*1024:
-                    break
-        except Exception as e:
+            await session.stop()
+        except Exception:
             pass
 
-async def get_media_session(client, file_id):
-    if not (media_session := client.media_sessions.get(file_id.dc_id, None)):
-        if file_id.dc_id != await client.storage.dc_id():
-            media_session = Session(client, file_id.dc_id, await Auth(client, file_id.dc_id, await client.storage.test_mode()).create(), await client.storage.test_mode(), is_media=True)
-            await media_session.start()
-
-            for _ in range(6):
-                exported_auth = await client.send(ExportAuthorization(dc_id=file_id.dc_id))
-                try:
-                    await media_session.send(ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
-                    break
-                except AuthBytesInvalid:
-                    continue
+    async def acquire(self):
+        async with self.lock:
+            for session in [s for s in self.sessions if not s.is_started.is_set()]:
+                await self._discard(session)
+            if len(self.sessions) < self.size and all(self.busy.values()):
+                session = await self._create()
             else:
-                await media_session.stop()
-                raise AuthBytesInvalid
-        else:
-            media_session = Session(client, file_id.dc_id, await client.storage.auth_key(), await client.storage.test_mode(), is_media=True)
-            await media_session.start()
-        client.media_sessions[file_id.dc_id] = media_session
-    return media_session
-
-async def stream_file(parts, bot):
-    parts.sort(key=lambda x: x["part_id"])
-    parts = [p["tg_file"] for p in parts]
-    for part in parts:
-        file = File(part, bot)
-        async for chunk in file.stream():
-            yield chunk
\ No newline at end of file
+                session = min(self.sessions, key=self.busy.get)
+            self.busy[session] += 1
+            return session
+
+    async def send(self, query):
+        session = await self.acquire()
+        try:
+            with telegram_duration.time(type(query).__name__, self.dc_id):
+                return await session.invoke(query)
+        except (OSError, TimeoutError):
+            async with self.lock:
+                await self._discard(session)
+            raise
+        finally:
+            if session in self.busy:
+                self.busy[session] -= 1
+
+    async def stop(self):
+        async with self.lock:
+            for session in list(self.sessions):
+                await self._discard(session)
+
+def get_media_pool(client, dc_id):
+    if not (pool := client.media_sessions.get(dc_id)):
+        pool = client.media_sessions[dc_id] = MediaSessionPool(client, dc_id)
+    return pool
+
+def part_key(part):
+    return part["part_id"], part.get("index", 0)
+
+def locate_parts(parts, start, end):
+    result = []
+    offset = 0
+    for part in sorted(parts, key=part_key):
+        part_start = part.get("offset", offset)
+        part_end = part_start + part["size"]
+        offset = part_end
+        if part_end <= start or part_start >= end:
+            continue
+        result.append((part, max(start, part_start) - part_start, min(end, part_end) - part_start))
+    return result
+
+async def stream_file(parts, bots, start=0, end=None, window=PREFETCH_CHUNKS):
+    if start == 0 and end is None:
+        parts = sorted(parts, key=part_key)
+        ranges = [(part, 0, part.get("size")) for part in parts]
+    else:
+        ranges = locate_parts(parts, start, end)
+    done = set()
+    plan = chain.from_iterable(File(part, bots).chunks(part_start, part_end, done) for part, part_start, part_end in ranges)
+    async for chunk in prefetch(plan, done, window):
+        yield chunk
+
+class UploadSizeMismatch(Exception):
+    pass
+
+class DocumentUpload:
+    def __init__(self, bots, size, file_name="file"):
+        self.bots = bots
+        self.client = bots.pick()
+        self.bots.load[self.client] += 1
+        self.size = size
+        self.file_name = file_name
+        self.upload_id = self.client.rnd_id()
+        self.total = max(-(-size // UPLOAD_PART_SIZE), 1)
+        self.big = size > BIG_FILE_SIZE
+        self.checksum = md5()
+        self.sha256 = sha256()
+        self.workers = Semaphore(UPLOAD_WORKERS)
+        self.tasks = set()
+        self.part = 0
+        self.cached = bytearray()
+        self.staged = []
+
+    async def _save(self, part, data):
+        try:
+            if self.big:
+                await self.bots.send(self.client, SaveBigFilePart(file_id=self.upload_id, file_part=part, file_total_parts=self.total, bytes=data))
+            else:
+                await self.bots.send(self.client, SaveFilePart(file_id=self.upload_id, file_part=part, bytes=data))
+        finally:
+            self.workers.release()
+
+    async def write(self, data, *digests):
+        await update_digests(data, self.checksum, self.sha256, *digests)
+        for task in [t for t in self.tasks if t.done()]:
+            self.tasks.discard(task)
+            task.result()
+        await self.workers.acquire()
+        self.tasks.add(create_task(self._save(self.part, data)))
+        self.part += 1
+        if cache_uploads:
+            self.cached += data
+            if len(self.cached) >= CHUNK_SIZE or self.part == self.total:
+                self.staged.append(len(self.staged) * CHUNK_SIZE)
+                await chunk_cache.put((self.upload_id, self.staged[-1]), bytes(self.cached))
+                self.cached = bytearray()
+
+    async def finish(self):
+        try:
+            await gather(*self.tasks)
+            if self.big:
+                file = InputFileBig(id=self.upload_id, parts=self.total, name=self.file_name)
+            else:
+                file = InputFile(id=self.upload_id, parts=self.total, name=self.file_name, md5_checksum="")
+            media = InputMediaUploadedDocument(mime_type="application/octet-stream", file=file, attributes=[DocumentAttributeFilename(file_name=self.file_name)], force_file=True)
+            r = await self.bots.send(self.client, SendMedia(peer=await self.client.resolve_peer(self.bots.chat_id), media=media, message="", random_id=self.client.rnd_id()))
+        finally:
+            self.bots.load[self.client] -= 1
+        for update in r.updates:
+            if isinstance(update, (UpdateNewMessage, UpdateNewChannelMessage)):
+                msg = await Message._parse(self.client, update.message, {u.id: u for u in r.users}, {c.id: c for c in r.chats})
+                break
+        if self.staged:
+            media_id = FileId.decode(msg.document.file_id).media_id
+            for offset in self.staged:
+                chunk_cache.rename((self.upload_id, offset), (media_id, offset))
+        return {
+            "tg_file": msg.document.file_id,
+            "tg_message": msg.id,
+            "bot": self.bots.ids[self.client],
+            "size": self.size,
+            "hash": self.checksum.hexdigest(),
+            "sha256": self.sha256.hexdigest()
+        }
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+        self.bots.load[self.client] -= 1
+
+async def upload_stream(bots, chunks, size, part_size=OBJECT_PART_SIZE, file_name="file"):
+    checksum = md5()
+    head = b""
+    buf = bytearray()
+    received = 0
+    if not size:
+        # Telegram rejects empty file parts, so zero-byte objects are stored without a document.
+        async for chunk in chunks:
+            if chunk:
+                raise UploadSizeMismatch
+        return [], checksum.hexdigest(), head
+    sizes = [part_size] * (size // part_size) + ([size % part_size] if size % part_size else [])
+    document = DocumentUpload(bots, sizes[0], file_name)
+    finishing = []
+
+    async def flush(data):
+        nonlocal document
+        await document.write(data, checksum)
+        if document.part == document.total:
+            finishing.append(create_task(document.finish()))
+            if len(finishing) < len(sizes):
+                document = DocumentUpload(bots, sizes[len(finishing)], file_name)
+
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            if received > size:
+                raise UploadSizeMismatch
+            if len(head) < SNIFF_SIZE:
+                head += chunk[:SNIFF_SIZE - len(head)]
+            buf += chunk
+            while len(buf) >= UPLOAD_PART_SIZE:
+                await flush(bytes(buf[:UPLOAD_PART_SIZE]))
+                del buf[:UPLOAD_PART_SIZE]
+        if received != size:
+            raise UploadSizeMismatch
+        if buf:
+            await flush(bytes(buf))
+        documents = await gather(*finishing)
+    except BaseException:
+        if len(finishing) < len(sizes):
+            document.cancel()
+        for task in finishing:
+            task.cancel()
+        if (uploaded := [t.result()["tg_message"] for t in finishing if t.done() and not t.cancelled() and not t.exception()]):
+            await bots.delete_messages(uploaded)
+        raise
+    return documents, checksum.hexdigest(), head
\ No newline at end of file
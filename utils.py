@@ -1,10 +1,97 @@
-from hashlib import md5
-
-def patch_binaryio(io):
-    m = md5()
-    oread = io.read
-    def _read(*args, **kwargs):
-        data = oread(*args, **kwargs)
-        m.update(data)
-        return data
-    return m
+from asyncio import to_thread
+from collections import OrderedDict
+from time import monotonic
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+class TTLCache:
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if not (item := self.items.get(key)):
+            return None
+        value, expires = item
+        if expires < monotonic():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        self.items[key] = (value, monotonic() + self.ttl)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.items.clear()
+        else:
+            self.items.pop(key, None)
+
+def parse_range(header, size):
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, sep, end = header[6:].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not start:
+            if not end or (suffix := int(end)) <= 0:
+                return False
+            return max(size - suffix, 0), size
+        start = int(start)
+        end = int(end) + 1 if end else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        return False
+    return start, min(end, size)
+
+OFFLOAD_SIZE = 64 * 1024
+
+def _update(data, digests):
+    for digest in digests:
+        digest.update(data)
+
+async def update_digests(data, *digests):
+    if len(data) >= OFFLOAD_SIZE:
+        await to_thread(_update, data, digests)
+    else:
+        _update(data, digests)
+
+def _http_date(value):
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+def _etag_matches(header, etag, weak=False):
+    tags = [t.strip() for t in header.split(",")]
+    if weak:
+        tags = [t[2:] if t.startswith("W/") else t for t in tags]
+    return "*" in tags or f'"{etag}"' in tags
+
+def check_preconditions(headers, etag, modified):
+    if (match := headers.get("If-Match")):
+        if not _etag_matches(match, etag):
+            return 412
+    elif (since := _http_date(headers.get("If-Unmodified-Since"))) is not None and modified > since:
+        return 412
+    if (none_match := headers.get("If-None-Match")):
+        if _etag_matches(none_match, etag, weak=True):
+            return 304
+    elif (since := _http_date(headers.get("If-Modified-Since"))) is not None and modified <= since:
+        return 304
+    return None
+
+def localName(tag):
+    return tag.rsplit("}", 1)[-1]